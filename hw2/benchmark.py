@@ -0,0 +1,151 @@
+import sys, time, random, tracemalloc
+
+import numpy as np
+
+from ngrams import START, STOP
+from ngramstore import NgramStore, LogProbTable
+from smoothing import AddAlphaBigramModel, MODELS
+
+
+def read_tokenized(fname):
+    """returns the non-empty lines of a file split on whitespace, so the benchmarks don't depend on the tokenizers"""
+    with open(fname, "r") as fin:
+        return [line.split() for line in fin if line.strip()]
+
+
+def timed(func, *args):
+    """Runs func and returns its result and the wall time"""
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+def measure(func, *args):
+    """Runs func and returns its result, the wall time and the memory it still holds afterwards in MB.
+    Tracing slows down Python code, so the time comes from a separate untraced run"""
+    start = time.perf_counter()
+    func(*args)
+    elapsed = time.perf_counter() - start
+    tracemalloc.start()
+    result = func(*args)
+    held = tracemalloc.get_traced_memory()[0] / 2**20
+    tracemalloc.stop()
+    return result, elapsed, held
+
+
+def build_nested(seqs, n):
+    """Counts n-grams the way the assignment specifies, as a dict of context string : dict of token : count"""
+    freqdict = {}
+    for seq in seqs:
+        padded = [START] * (n-1) + list(seq) + [STOP]
+        for i in range(n-1, len(padded)):
+            context = " ".join(padded[i-n+1:i])
+            tokens = freqdict.setdefault(context, {})
+            tokens[padded[i]] = tokens.get(padded[i], 0) + 1
+    return freqdict
+
+
+def build_nested_orders(seqs, maxorder):
+    """One nested dictionary per order, each built in its own pass"""
+    return [build_nested(seqs, n) for n in range(1, maxorder+1)]
+
+
+def bench_store(fname="flatland_clean.txt", maxorder=3):
+    """Compares building nested string dictionaries for orders 1 to maxorder against building one NgramStore"""
+    seqs = read_tokenized(fname)
+    nested, nestedtime, nestedmem = measure(build_nested_orders, seqs, maxorder)
+    store, storetime, storemem = measure(NgramStore.from_sequences, seqs, maxorder)
+    numngrams = sum(len(tokens) for freqdict in nested for tokens in freqdict.values())
+
+    print("%s lines, %s n-grams of orders 1-%s" % (len(seqs), len(store), maxorder))
+    print("\t\ttime (s)\tmemory (MB)\tbytes/n-gram")
+    print("nested dicts\t%.3f\t\t%.2f\t\t%.1f" % (nestedtime, nestedmem, nestedmem * 2**20 / numngrams))
+    print("NgramStore\t%.3f\t\t%.2f\t\t%.1f" % (storetime, storemem, storemem * 2**20 / len(store)))
+    print("(key and count arrays alone: %.1f bytes/n-gram, the rest is the vocabulary)" % (store.nbytes / len(store)))
+
+
+def get_nested_logprobs(table):
+    """Converts a LogProbTable to the assignment's dict of context string : dict of token : log probability"""
+    logprobs = {}
+    for key, logprob in zip(table.keys.tolist(), table.logprobs.tolist()):
+        ngram = [table.store.tokens[i] for i in table.store.unpack(key, table.order)]
+        logprobs.setdefault(" ".join(ngram[:-1]), {})[ngram[-1]] = logprob
+    return logprobs
+
+
+def score_nested(seq, logprobs, n):
+    """Scores one padded token sequence one n-gram at a time, like ngrams.score_sequence"""
+    padded = [START] * (n-1) + list(seq) + [STOP]
+    total = 0.0
+    for i in range(n-1, len(padded)):
+        logprob = logprobs.get(" ".join(padded[i-n+1:i]), {}).get(padded[i])
+        if logprob is None:
+            return float("-inf")
+        total += logprob
+    return total
+
+
+def score_all_nested(seqs, logprobs, n):
+    return [score_nested(seq, logprobs, n) for seq in seqs]
+
+
+def split_heldout(seqs, numheldout, heldoutfrac=0.1, seed=0):
+    """Trains on the first 1-heldoutfrac of the lines. Samples numheldout lines with replacement from the rest,
+    and as many from the training lines, which have no unseen n-grams to stop the per-sequence scorer early"""
+    numtrain = int(len(seqs) * (1-heldoutfrac))
+    rng = random.Random(seed)
+    return (seqs[:numtrain], [rng.choice(seqs[numtrain:]) for i in range(numheldout)],
+            [rng.choice(seqs[:numtrain]) for i in range(numheldout)])
+
+
+def bench_scoring(fname="flatland_clean.txt", order=3, numheldout=100000):
+    """Times scoring held-out lines one at a time against nested dictionaries versus all at once with LogProbTable"""
+    train, heldout, seen = split_heldout(read_tokenized(fname), numheldout)
+    table = LogProbTable.from_store(NgramStore.from_sequences(train, order), order)
+    logprobs = get_nested_logprobs(table)
+
+    print("order %s\t\t\tlines\t-inf\tper-sequence (s)\tbatched (s)\tspeedup\tsame scores" % order)
+    for title, seqs in (("held-out", heldout), ("training sample", seen)):
+        start = time.perf_counter()
+        nestedscores = score_all_nested(seqs, logprobs, order)
+        nestedtime = time.perf_counter() - start
+        start = time.perf_counter()
+        batchscores = table.score_batch(seqs)
+        batchtime = time.perf_counter() - start
+        print("%s\t%s\t%s\t%.3f\t\t\t%.3f\t\t%.1fx\t%s" % (title.ljust(16), len(seqs), np.isinf(batchscores).sum(), nestedtime,
+                                                             batchtime, nestedtime/batchtime, np.allclose(nestedscores, batchscores)))
+
+
+def bench_perplexity(fname="flatland_clean.txt", maxorder=4, heldoutfrac=0.1):
+    """Reports held-out perplexity and build and scoring times of the smoothed models of orders 1 to maxorder.
+    The last heldoutfrac of the lines are held out. Stupid Backoff scores aren't normalized, so its perplexity
+    is only comparable across its own orders"""
+    seqs = read_tokenized(fname)
+    numtrain = int(len(seqs) * (1-heldoutfrac))
+    train, heldout = seqs[:numtrain], seqs[numtrain:]
+    numtokens = sum(len(seq)+1 for seq in heldout)
+
+    print("%s training lines, %s held-out lines, %s held-out tokens with STOP" % (len(train), len(heldout), numtokens))
+    print("%s\torder\tperplexity\tbuild (s)\tscore (s)" % "model".ljust(16))
+    for order in range(1, maxorder+1):
+        table = LogProbTable.from_store(NgramStore.from_sequences(train, order), order)
+        print("%s\t%s\t%.1f" % ("unsmoothed".ljust(16), order, np.exp(-table.score_batch(heldout).sum() / numtokens)))
+    addalpha = AddAlphaBigramModel.from_sequences(train, 1)
+    for alpha in (1, 0.1, 0.01):
+        # the same model, since alpha only matters on lookup
+        addalpha.alpha = alpha
+        print("%s\t2\t%.1f" % (("add-%s" % alpha).ljust(16), np.exp(-addalpha.score_batch(heldout).sum() / numtokens)))
+    for method in sorted(MODELS):
+        for order in range(1, maxorder+1):
+            model, buildtime = timed(MODELS[method].from_sequences, train, order)
+            perplexity, scoretime = timed(model.perplexity, heldout)
+            print("%s\t%s\t%.1f\t\t%.3f\t\t%.3f" % (method.ljust(16), order, perplexity, buildtime, scoretime))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "score":
+        bench_scoring(*sys.argv[2:3], *[int(arg) for arg in sys.argv[3:5]])
+    elif len(sys.argv) > 1 and sys.argv[1] == "perplexity":
+        bench_perplexity(*sys.argv[2:3], *[int(arg) for arg in sys.argv[3:4]])
+    else:
+        bench_store(sys.argv[1] if len(sys.argv) > 1 else "flatland_clean.txt", int(sys.argv[2]) if len(sys.argv) > 2 else 3)
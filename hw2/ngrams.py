@@ -1,6 +1,8 @@
 import re
 from math import log, exp
 
+import smoothing
+
 START = "<START>"
 STOP = "<STOP>"
 OOV = "<OOV>"
@@ -100,6 +102,20 @@ def get_ngramlogprobs_fromcorpus(tokenizedseqs, n):
     """
     return
 
+
+def get_smoothed_ngram_model(tokenizedseqs, n, method="kneserney"):
+    """builds an n-gram model of any order that backs off to lower orders instead of giving unseen ngrams -inf
+    input:
+        tokenizedlines (list): a list of tokenized lines. Each tokenized line is a list of tokens
+        n (int): ngram width. 1 for unigram, 2 for bigram, 3 for trigram, etc.
+        method (str): "kneserney" for interpolated Kneser-Ney, "stupidbackoff" for Stupid Backoff
+    return:
+        (BackoffModel): looked up like a dict mapping contexts to tokens, tokens to log probabilities,
+                        where a context is a tuple of the previous n-1 tokens or a string of them joined with
+                        spaces. Works with score_sequence
+    """
+    return smoothing.MODELS[method].from_sequences(tokenizedseqs, n)
+
     
 def addalpha_bigram(freqdict, alpha):
     """performs add alpha smoothing on bigram frequencies, include OOV
@@ -118,9 +134,10 @@ def get_bigramlogprobs_fromcorpus_addalpha(tokenizedseqs, alpha):
         tokenizedlines (list): a list of tokenized lines. Each tokenized line is a list of tokens
         alpha (num): smoothing parameter
     return:
-        (dict str:dict str:num): dict mapping contexts to tokens, tokens to smoothed log probabilities 
+        (AddAlphaBigramModel): looked up like a dict mapping contexts to tokens, tokens to smoothed log probabilities,
+                               but computes each one from the observed counts instead of storing every cell
     """
-    return
+    return smoothing.AddAlphaBigramModel.from_sequences(tokenizedseqs, alpha)
 
 
 def replace_OOV(seq, typeset):
@@ -138,7 +155,9 @@ def score_sequence(seq, ngramlogprobs):
     """Scores a sequence of ngrams
     input:
         seq (seq): a sequence of ngrams
-        ngramlogprobs (dict str:dict str:num): dict mapping contexts to tokens, tokens to log probabilities
+        ngramlogprobs (dict str:dict str:num): dict mapping contexts to tokens, tokens to log probabilities,
+                                               or a model from get_bigramlogprobs_fromcorpus_addalpha or
+                                               get_smoothed_ngram_model, which is looked up the same way
     return:
         float('-inf') if any ngram is missing from ngramlogprobs. log probability of the sequence otherwise
     """
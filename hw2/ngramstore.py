@@ -0,0 +1,217 @@
+from collections import Counter
+from itertools import chain, repeat
+
+import numpy as np
+
+import ngrams
+
+# usable bits of a packed key. The sign bit is left alone so keys sort the same as signed int64s
+KEY_BITS = 63
+
+
+def search(table, keys):
+    """Looks up packed keys in a sorted key array.
+    returns (index of each key in table, or of some other entry if it is missing; boolean array of which keys were found)"""
+    if not len(table):
+        return np.zeros(len(keys), dtype=np.int64), np.zeros(len(keys), dtype=bool)
+    # searching in sorted order walks the table front to back instead of jumping around it
+    sortorder = np.argsort(keys)
+    i = np.empty(len(keys), dtype=np.int64)
+    i[sortorder] = np.minimum(np.searchsorted(table, keys[sortorder]), len(table)-1)
+    return i, table[i] == keys
+
+
+def group_by_context(keys, values, bits):
+    """Groups the sorted packed keys of one order by their context, the key without its last ID.
+    returns (sorted context keys, sum of values for each context, number of keys with each context,
+             index of each key's context in the context keys)"""
+    contexts = keys >> bits
+    starts = np.flatnonzero(np.r_[True, contexts[1:] != contexts[:-1]]) if len(keys) else np.zeros(0, dtype=np.int64)
+    totals = np.add.reduceat(values, starts) if len(keys) else values[:0]
+    sizes = np.diff(np.r_[starts, len(keys)])
+    return contexts[starts], totals, sizes, np.repeat(np.arange(len(starts)), sizes)
+
+
+class NgramStore(object):
+    """Counts of the n-grams of every order from 1 to maxorder, built in one pass over the corpus.
+    Tokens are interned to integer IDs, and once finalized the n-grams of each order are kept as a sorted
+    array of int64 keys, each packing an n-gram's IDs into bits bits apiece, plus a parallel array of counts.
+    Sequences are padded per order as in ngrams.pad: n-1 STARTs before and one STOP after"""
+
+    def __init__(self, maxorder):
+        self.maxorder = maxorder # highest n-gram order counted
+        self.tokens = [ngrams.START, ngrams.STOP, ngrams.OOV] # ID : token
+        self.ids = dict((token, i) for i, token in enumerate(self.tokens)) # token : ID
+        self.pending = [Counter() for order in range(maxorder)] # int tuple counts of each order, until finalize
+        self.bits = None # bits per ID in a packed key, set by finalize
+        self.keys = [] # sorted packed keys of each order, set by finalize
+        self.counts = [] # count of each key, parallel to keys
+
+    @classmethod
+    def from_sequences(cls, seqs, maxorder):
+        """Counts every order up to maxorder in a single pass over token sequences and finalizes the store"""
+        store = cls(maxorder)
+        for seq in seqs:
+            store.add_sequence(seq)
+        return store.finalize()
+
+    def get_id(self, token):
+        """returns the ID of a token, assigning a new one if it hasn't been seen"""
+        if token not in self.ids:
+            self.ids[token] = len(self.tokens)
+            self.tokens.append(token)
+        return self.ids[token]
+
+    def encode(self, seq):
+        """returns the IDs of a token sequence, with OOV's ID for tokens that haven't been seen"""
+        oov = self.ids[ngrams.OOV]
+        return [self.ids.get(token, oov) for token in seq]
+
+    def add_sequence(self, seq):
+        """Counts the n-grams of every order in one token sequence"""
+        startid, stopid = self.ids[ngrams.START], self.ids[ngrams.STOP]
+        # padded for the highest order. Lower orders need fewer STARTs, so they start further in
+        padded = [startid] * (self.maxorder-1) + [self.get_id(token) for token in seq] + [stopid]
+        for order in range(1, self.maxorder+1):
+            start = self.maxorder - order
+            self.pending[order-1].update(zip(*[padded[start+i:] for i in range(order)]))
+
+    def finalize(self):
+        """Packs the pending counts into sorted key and count arrays. Returns the store.
+        raises ValueError if the IDs of a maxorder n-gram don't fit in a 63 bit key"""
+        self.bits = max(1, (len(self.tokens)-1).bit_length())
+        if self.bits * self.maxorder > KEY_BITS:
+            raise ValueError("%s-grams over %s types need %s bit keys, more than %s" % (self.maxorder, len(self.tokens),
+                                                                                     self.bits * self.maxorder, KEY_BITS))
+        self.keys = []
+        self.counts = []
+        for order, pending in enumerate(self.pending, 1):
+            grams = np.array(list(pending), dtype=np.int64).reshape(-1, order)
+            keys = self.pack_array(grams)
+            counts = np.fromiter(pending.values(), dtype=np.int64, count=len(pending))
+            sortorder = np.argsort(keys)
+            self.keys.append(keys[sortorder])
+            self.counts.append(counts[sortorder])
+        self.pending = None
+        return self
+
+    def pack(self, ids):
+        """returns the packed key of one n-gram of IDs"""
+        key = 0
+        for i in ids:
+            key = (key << self.bits) | i
+        return key
+
+    def pack_array(self, grams):
+        """returns the packed keys of an array of n-grams of IDs, one n-gram per row"""
+        keys = np.zeros(len(grams), dtype=np.int64)
+        for column in range(grams.shape[1]):
+            keys = (keys << self.bits) | grams[:, column]
+        return keys
+
+    def unpack(self, key, order):
+        """returns the IDs of an order n-gram from its packed key"""
+        mask = (1 << self.bits) - 1
+        return tuple((key >> (self.bits * (order-1-i))) & mask for i in range(order))
+
+    def get_count(self, ngram):
+        """returns the count of an n-gram given as a sequence of tokens, 0 if it was never seen"""
+        order = len(ngram)
+        if order > self.maxorder or any(token not in self.ids for token in ngram):
+            return 0
+        key = self.pack(self.ids[token] for token in ngram)
+        keys = self.keys[order-1]
+        i = np.searchsorted(keys, key)
+        return int(self.counts[order-1][i]) if i < len(keys) and keys[i] == key else 0
+
+    def encode_batch(self, seqs, order):
+        """Maps token sequences to the packed keys of all their padded n-grams of an order, with OOV's ID for unseen tokens.
+        returns (keys, offsets) where the n-grams of sequence i are keys[offsets[i]:offsets[i+1]]"""
+        seqs = [seq if isinstance(seq, list) else list(seq) for seq in seqs]
+        lengths = np.fromiter(map(len, seqs), dtype=np.int64, count=len(seqs))
+        tokens = list(chain.from_iterable(seqs))
+        # dict.get with a default, called from map, keeps the per-token work out of the interpreter loop
+        tokenids = np.fromiter(map(self.ids.get, tokens, repeat(self.ids[ngrams.OOV])), dtype=np.int64, count=len(tokens))
+
+        # Lay the sequences out one after another, each with order-1 STARTs before it and a STOP after it
+        padstarts = np.r_[0, np.cumsum(lengths + order)][:-1]
+        ids = np.full(int(lengths.sum()) + len(seqs) * order, self.ids[ngrams.START], dtype=np.int64)
+        tokenstarts = np.r_[0, np.cumsum(lengths)][:-1]
+        ids[np.repeat(padstarts + order-1 - tokenstarts, lengths) + np.arange(len(tokens))] = tokenids
+        ids[padstarts + order-1 + lengths] = self.ids[ngrams.STOP]
+
+        # each sequence has one n-gram per token plus one ending in STOP, starting at every padded position
+        offsets = np.r_[0, np.cumsum(lengths + 1)]
+        starts = np.repeat(padstarts - offsets[:-1], lengths + 1) + np.arange(offsets[-1])
+        keys = np.zeros(len(starts), dtype=np.int64)
+        for i in range(order):
+            keys = (keys << self.bits) | ids[starts+i]
+        return keys, offsets
+
+    def get_counts(self, keys, order):
+        """returns the count of every packed key of an order, 0 for n-grams that were never seen"""
+        i, found = search(self.keys[order-1], keys)
+        return np.where(found, self.counts[order-1][i], 0) if len(self.keys[order-1]) else i
+
+    def get_suffix_counts(self, order):
+        """Counts the n-grams of a lower order that end each maxorder n-gram, i.e. the lower order n-grams of the
+        sequences padded for maxorder, which are the ones a maxorder model backs off to
+        returns (sorted packed keys, counts)"""
+        suffixes = self.keys[-1] & ((1 << self.bits * order) - 1)
+        keys, inverse = np.unique(suffixes, return_inverse=True)
+        return keys, np.bincount(inverse.ravel(), weights=self.counts[-1], minlength=len(keys)).astype(np.int64)
+
+    def get_continuation_counts(self, order):
+        """Counts how many different types come right before each n-gram of an order below maxorder,
+        among the n-grams of the sequences padded for maxorder
+        returns (sorted packed keys, continuation counts)"""
+        extended = np.unique(self.keys[-1] & ((1 << self.bits * (order+1)) - 1))
+        return np.unique(extended & ((1 << self.bits * order) - 1), return_counts=True)
+
+    def iter_ngrams(self, order):
+        """Yields (n-gram as a tuple of tokens, count) for every n-gram of an order, in key order"""
+        for key, count in zip(self.keys[order-1].tolist(), self.counts[order-1].tolist()):
+            yield tuple(self.tokens[i] for i in self.unpack(key, order)), count
+
+    def __len__(self):
+        """number of distinct n-grams of all orders"""
+        return sum(len(keys) for keys in self.keys)
+
+    @property
+    def nbytes(self):
+        """bytes taken by the key and count arrays"""
+        return sum(keys.nbytes + counts.nbytes for keys, counts in zip(self.keys, self.counts))
+
+
+class LogProbTable(object):
+    """Maximum likelihood log probabilities of the n-grams of one order of an NgramStore, keyed by the same
+    packed keys, for scoring many token sequences at once with vectorized lookups"""
+
+    def __init__(self, store, order, keys, logprobs):
+        self.store = store # NgramStore the table was made from, for its vocabulary and key packing
+        self.order = order # n-gram order
+        self.keys = keys # sorted packed keys
+        self.logprobs = logprobs # log probability of each key given its context, parallel to keys
+
+    @classmethod
+    def from_store(cls, store, order):
+        """Computes log(count of n-gram / count of its context) for every n-gram of an order.
+        Keys sharing a context are adjacent, since the context is the high bits of the key"""
+        keys = store.keys[order-1]
+        counts = store.counts[order-1]
+        contexts, totals, sizes, contextindex = group_by_context(keys, counts, store.bits)
+        return cls(store, order, keys, np.log(counts) - np.log(totals[contextindex]))
+
+    def lookup(self, keys):
+        """returns the log probability of every packed key, -inf for n-grams that were never seen"""
+        i, found = search(self.keys, keys)
+        return np.where(found, self.logprobs[i], -np.inf) if len(self.keys) else np.full(len(keys), -np.inf)
+
+    def score_batch(self, seqs):
+        """Scores many token sequences at once. Each sequence is padded like ngrams.pad, and its score is the sum of
+        the log probabilities of its n-grams, -inf if any of them was never seen, as in ngrams.score_sequence
+        returns (array): one score per sequence"""
+        keys, offsets = self.store.encode_batch(seqs, self.order)
+        if not len(keys):
+            return np.zeros(0)
+        return np.add.reduceat(self.lookup(keys), offsets[:-1])
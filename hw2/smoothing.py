@@ -0,0 +1,240 @@
+import numpy as np
+
+import ngrams
+from ngramstore import NgramStore, search, group_by_context
+
+# discount for an order whose counts of 1 and 2 can't be used to estimate one
+DEFAULT_DISCOUNT = 0.75
+
+
+class AddAlphaBigramModel(object):
+    """Add-alpha smoothed bigram log probabilities, computed on lookup from the observed counts and context totals
+    instead of a table with a cell for every context and vocabulary type. alpha can be changed at any time.
+    It can be used like the dict of context : dict of token : log probability that addalpha_bigram leads to:
+    model[context][token] is log((count + alpha) / (context total + alpha*V)), where V counts every type
+    that can follow a context, including STOP and OOV. Contexts and tokens outside the vocabulary raise KeyError"""
+
+    def __init__(self, store, alpha):
+        self.store = store # NgramStore with bigram counts
+        self.alpha = alpha # smoothing parameter
+        keys = store.keys[1]
+        # total count of the bigrams starting with each type, indexed by ID
+        self.contexttotals = np.bincount(keys >> store.bits, weights=store.counts[1], minlength=len(store.tokens))
+        self.numtypes = len(store.tokens) - 1 # every type but START can follow a context
+
+    @classmethod
+    def from_sequences(cls, seqs, alpha):
+        """Counts the bigrams of token sequences in one pass"""
+        return cls(NgramStore.from_sequences(seqs, 2), alpha)
+
+    def get_logprob(self, contextid, tokenid):
+        """returns the smoothed log probability of a bigram of IDs"""
+        count = self.store.get_counts(np.array([self.store.pack((contextid, tokenid))]), 2)[0]
+        return float(np.log(count + self.alpha) - np.log(self.contexttotals[contextid] + self.alpha * self.numtypes))
+
+    def get_token_id(self, token):
+        """returns the ID of a token that can follow a context, or None"""
+        return self.store.ids.get(token) if token != ngrams.START else None
+
+    def score_batch(self, seqs):
+        """Scores many token sequences at once, padded like ngrams.pad, with unseen tokens counted as OOV
+        returns (array): sum of the smoothed bigram log probabilities of each sequence"""
+        keys, offsets = self.store.encode_batch(seqs, 2)
+        if not len(keys):
+            return np.zeros(0)
+        counts = self.store.get_counts(keys, 2)
+        logprobs = np.log(counts + self.alpha) - np.log(self.contexttotals[keys >> self.store.bits] + self.alpha * self.numtypes)
+        return np.add.reduceat(logprobs, offsets[:-1])
+
+    def __getitem__(self, context):
+        if context not in self:
+            raise KeyError(context)
+        return ContextLogProbs(self, self.store.ids[context])
+
+    def get(self, context, default=None):
+        return self[context] if context in self else default
+
+    def __contains__(self, context):
+        return context in self.store.ids and context != ngrams.STOP
+
+    def __iter__(self):
+        """Yields every context, i.e. every type but STOP"""
+        return (token for token in self.store.tokens if token != ngrams.STOP)
+
+    def __len__(self):
+        return len(self.store.tokens) - 1
+
+
+class BackoffModel(object):
+    """Shared interface of the smoothed models of any order built on an NgramStore. Tokens outside the vocabulary are
+    looked up as OOV. model[context][token] is the log probability of token after context, which is a tuple of
+    previous tokens or a string of them joined with spaces, as in the assignment's dictionaries. Only its last
+    order-1 tokens are used, and shorter contexts are padded with START. Subclasses define get_logprobs(keys),
+    which returns the log probability of the last ID of each packed maxorder key given the ones before it"""
+
+    def __init__(self, store):
+        self.store = store # NgramStore holding the counts
+        self.order = store.maxorder # n-gram order
+        self.numtypes = len(store.tokens) - 1 # every type but START can follow a context
+
+    @classmethod
+    def from_sequences(cls, seqs, order, **params):
+        """Counts the n-grams of token sequences in one pass and builds the model"""
+        return cls(NgramStore.from_sequences(seqs, order), **params)
+
+    def get_logprob(self, contextids, tokenid):
+        """returns the log probability of a token ID after a tuple of context IDs"""
+        contextids = contextids[len(contextids)-(self.order-1):] if self.order > 1 else ()
+        padding = (self.store.ids[ngrams.START],) * (self.order-1 - len(contextids))
+        return float(self.get_logprobs(np.array([self.store.pack(padding + contextids + (tokenid,))]))[0])
+
+    def score_batch(self, seqs):
+        """Scores many token sequences at once, padded like ngrams.pad
+        returns (array): sum of the log probabilities of the n-grams of each sequence"""
+        keys, offsets = self.store.encode_batch(seqs, self.order)
+        if not len(keys):
+            return np.zeros(0)
+        return np.add.reduceat(self.get_logprobs(keys), offsets[:-1])
+
+    def perplexity(self, seqs):
+        """returns the perplexity of token sequences, counting STOP as a token"""
+        keys, offsets = self.store.encode_batch(seqs, self.order)
+        return float(np.exp(-self.get_logprobs(keys).sum() / len(keys)))
+
+    def get_token_id(self, token):
+        """returns the ID of a token that can follow a context, OOV's for tokens outside the vocabulary, or None for START"""
+        return self.store.ids.get(token, self.store.ids[ngrams.OOV]) if token != ngrams.START else None
+
+    def get_context_tokens(self, context):
+        """returns a context as a tuple of tokens. A string is a single token if it is in the vocabulary,
+        and otherwise split on spaces"""
+        if not isinstance(context, str):
+            return tuple(context)
+        if context in self.store.ids:
+            return (context,)
+        return tuple(context.split(" ")) if context else ()
+
+    def __getitem__(self, context):
+        context = self.get_context_tokens(context)
+        if ngrams.STOP in context:
+            raise KeyError(context)
+        oov = self.store.ids[ngrams.OOV]
+        return ContextLogProbs(self, tuple(self.store.ids.get(token, oov) for token in context))
+
+    def get(self, context, default=None):
+        return self[context] if context in self else default
+
+    def __contains__(self, context):
+        return ngrams.STOP not in self.get_context_tokens(context)
+
+
+class KneserNeyModel(BackoffModel):
+    """Interpolated Kneser-Ney smoothing of any order. The highest order uses the n-gram counts, and each lower
+    order the continuation counts, i.e. the number of different types seen before an n-gram, which are derived from
+    the highest order's keys. The discounted probabilities of every n-gram and the backoff weight of every context
+    are computed up front, so a lookup is one search per order. Unigrams are interpolated with a uniform distribution,
+    so unseen tokens get some probability too"""
+
+    def __init__(self, store, discounts=None):
+        BackoffModel.__init__(self, store)
+        self.discounts = [] # discount of each order, estimated from its counts unless given
+        self.tables = [] # for each order from 2 up, (n-gram keys, discounted probabilities, context keys, backoff weights)
+        for order in range(1, self.order+1):
+            if order == self.order:
+                keys, counts = store.keys[-1], store.counts[-1]
+            else:
+                keys, counts = store.get_continuation_counts(order)
+            discount = discounts[order-1] if discounts else estimate_discount(counts)
+            self.discounts.append(discount)
+            if order == 1:
+                total = counts.sum()
+                # probability of every ID, with the discounted mass spread evenly over the vocabulary
+                self.unigrams = np.full(len(store.tokens), discount * len(keys) / total / self.numtypes)
+                self.unigrams[keys] += np.maximum(counts - discount, 0) / total
+            else:
+                contexts, totals, sizes, contextindex = group_by_context(keys, counts, store.bits)
+                self.tables.append((keys, np.maximum(counts - discount, 0) / totals[contextindex], contexts, discount * sizes / totals))
+
+    def get_logprobs(self, keys):
+        bits = self.store.bits
+        probs = self.unigrams[keys & ((1 << bits) - 1)]
+        for order, (ngramkeys, weights, contexts, backoffs) in enumerate(self.tables, 2):
+            suffixes = keys & ((1 << bits * order) - 1)
+            i, found = search(ngramkeys, suffixes)
+            j, contextfound = search(contexts, suffixes >> bits)
+            if len(contexts):
+                probs = np.where(contextfound, np.where(found, weights[i], 0) + backoffs[j] * probs, probs)
+        return np.log(probs)
+
+
+class StupidBackoffModel(BackoffModel):
+    """Stupid Backoff of any order: the relative frequency of the longest n-gram seen in the training data, times
+    backoff for every order backed off. The counts of every order come from the highest order's keys. Unigrams are
+    add-one smoothed so unseen tokens get a score. The scores are not normalized, so they aren't true probabilities"""
+
+    def __init__(self, store, backoff=0.4):
+        BackoffModel.__init__(self, store)
+        self.backoff = backoff # factor applied for each order backed off
+        self.tables = [] # for each order from 2 up, (n-gram keys, log relative frequencies)
+        for order in range(1, self.order+1):
+            keys, counts = store.get_suffix_counts(order)
+            if order == 1:
+                self.unigrams = np.full(len(store.tokens), -np.log(counts.sum() + self.numtypes))
+                self.unigrams[keys] += np.log(counts + 1)
+            else:
+                contexts, totals, sizes, contextindex = group_by_context(keys, counts, store.bits)
+                self.tables.append((keys, np.log(counts) - np.log(totals[contextindex])))
+
+    def get_logprobs(self, keys):
+        bits = self.store.bits
+        logbackoff = np.log(self.backoff)
+        scores = self.unigrams[keys & ((1 << bits) - 1)] + (self.order-1) * logbackoff
+        done = np.zeros(len(keys), dtype=bool)
+        # from the highest order down, so each n-gram gets the longest match
+        for order in range(self.order, 1, -1):
+            ngramkeys, logfreqs = self.tables[order-2]
+            i, found = search(ngramkeys, keys & ((1 << bits * order) - 1))
+            use = found & ~done
+            scores[use] = logfreqs[i[use]] + (self.order-order) * logbackoff
+            done |= found
+        return scores
+
+
+def estimate_discount(counts):
+    """returns the discount n1 / (n1 + 2*n2) from the numbers of n-grams seen once and twice, or DEFAULT_DISCOUNT"""
+    n1 = np.count_nonzero(counts == 1)
+    n2 = np.count_nonzero(counts == 2)
+    return n1 / (n1 + 2*n2) if n1 and n2 else DEFAULT_DISCOUNT
+
+
+# smoothed models of any order, by the name ngrams.get_smoothed_ngram_model takes
+MODELS = {"kneserney": KneserNeyModel,
+          "stupidbackoff": StupidBackoffModel}
+
+
+class ContextLogProbs(object):
+    """The smoothed log probabilities of every type following one context of an AddAlphaBigramModel or BackoffModel,
+    looked up like a dict of token : log probability"""
+
+    def __init__(self, model, contextid):
+        self.model = model # model the log probabilities come from
+        self.contextid = contextid # ID of the context, or tuple of IDs for a BackoffModel
+
+    def __getitem__(self, token):
+        tokenid = self.model.get_token_id(token)
+        if tokenid is None:
+            raise KeyError(token)
+        return self.model.get_logprob(self.contextid, tokenid)
+
+    def get(self, token, default=None):
+        return self[token] if token in self else default
+
+    def __contains__(self, token):
+        return self.model.get_token_id(token) is not None
+
+    def __iter__(self):
+        """Yields every type that can follow the context"""
+        return (token for token in self.model.store.tokens if token != ngrams.START)
+
+    def __len__(self):
+        return self.model.numtypes
@@ -0,0 +1,62 @@
+import io, bz2, gzip, argparse, resource
+
+import ngrams
+from ngramstore import NgramStore
+
+# size of each read from the input file
+BUFFER_SIZE = 2**20
+
+# leading bytes of compressed files : module that opens them
+COMPRESSED = ((b"\x1f\x8b", gzip), (b"BZh", bz2))
+
+
+def open_text(fname):
+    """Opens a plain, gzip or bz2 text file for reading with large buffered reads.
+    The compression is detected from the first bytes of the file, not its name"""
+    with open(fname, "rb") as fin:
+        magic = fin.read(3)
+    for prefix, module in COMPRESSED:
+        if magic.startswith(prefix):
+            return io.TextIOWrapper(io.BufferedReader(module.open(fname, "rb"), BUFFER_SIZE), encoding="utf-8")
+    return open(fname, "r", buffering=BUFFER_SIZE, encoding="utf-8")
+
+
+def iter_lines(fname):
+    """Lazy version of ngrams.read_lines_from_file: yields the stripped, non-empty lines of a file one at a time"""
+    with open_text(fname) as fin:
+        for line in fin:
+            line = line.strip()
+            if line:
+                yield line
+
+
+def build_stores(fname, maxorder):
+    """Counts word n-grams and character n-grams within words in a single streaming pass over a file,
+    so memory depends on the number of distinct n-grams rather than the size of the corpus
+    returns (word NgramStore, character NgramStore, number of lines)"""
+    wordstore = NgramStore(maxorder)
+    charstore = NgramStore(maxorder)
+    numlines = 0
+    for line in iter_lines(fname):
+        wordstore.add_sequence(ngrams.tokenize_words(line))
+        for chars in ngrams.tokenize_wordchars([line]):
+            charstore.add_sequence(chars)
+        numlines += 1
+    return wordstore.finalize(), charstore.finalize(), numlines
+
+
+def main(fname, maxorder):
+    wordstore, charstore, numlines = build_stores(fname, maxorder)
+    print("%s lines" % numlines)
+    for title, store in (("Words", wordstore), ("Characters", charstore)):
+        print("%s: %s types, %s n-grams of orders 1-%s in %.2f MB" % (title, len(store.tokens), len(store), maxorder, store.nbytes / 2**20))
+    # ru_maxrss is in kilobytes on Linux
+    print("Peak memory: %.1f MB" % (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("fname", nargs="?", default="flatland_clean.txt", help="text file to count, optionally gzip or bz2 compressed")
+    parser.add_argument("--order", type=int, default=3, help="count n-grams of orders 1 to ORDER")
+    args = parser.parse_args()
+    main(args.fname, args.order)
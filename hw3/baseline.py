@@ -11,16 +11,14 @@ def baseline_segs(tokenizeds):
     return
 
 def main():
-    train_utts = data.read_file("Brown_train_unseg.txt")
-    train_tokenized = [data.tokenize_syllables(utt) for utt in train_utts]
+    train_tokenized = list(data.load_corpus("Brown_train_unseg.txt"))
     baselinesegs_train = baseline_segs(train_tokenized)
  
-    test_utts = data.read_file("Brown_test_unseg.txt")
-    test_tokenized = [data.tokenize_syllables(utt) for utt in test_utts]
+    test_tokenized = list(data.load_corpus("Brown_test_unseg.txt"))
     baselinesegs_test = baseline_segs(test_tokenized)
 
-    goldsegs_train = data.get_goldsegs("Brown_train_gold.txt")
-    goldsegs_test = data.get_goldsegs("Brown_test_gold.txt")
+    goldsegs_train = data.get_goldsegs(data.load_corpus("Brown_train_gold.txt"))
+    goldsegs_test = data.get_goldsegs(data.load_corpus("Brown_test_gold.txt"))
 
     for basesegs, goldsegs, title in ((baselinesegs_train, goldsegs_train, "Training"), (baselinesegs_test, goldsegs_test, "Testing")):
         stats = data.evaluate(goldsegs, basesegs)
@@ -0,0 +1,72 @@
+import sys, time
+
+import data
+import transprob
+import subtractive
+from lexicon import SyllableTrie, load_lexicon
+
+
+def timed(func, *args):
+    """Runs func and returns its result and the wall time"""
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+def bench_transprob(trainfname="Brown_train_unseg.txt"):
+    """Times the per-utterance TP segmenter against the batched one on the training file
+    and checks that they find the same segmentation points"""
+    corpus = data.load_corpus(trainfname)
+    model = transprob.BigramModel.from_utterances(corpus)
+    probdict = model.to_probdict()
+    tokenizeds = list(corpus)
+
+    segs, pertime = timed(transprob.get_segpoints, tokenizeds, probdict)
+    mask, batchtime = timed(transprob.get_batch_segpoints, corpus, model)
+    batchsegs = data.mask_to_segs(mask, corpus.offsets)
+
+    print("per-utterance: %.3fs\tbatched: %.3fs" % (pertime, batchtime))
+    if segs is None:
+        print("get_segpoints is not implemented yet, so the outputs were not compared")
+    else:
+        print("speedup: %.1fx\tutterances that differ: %s" % (pertime/batchtime, sum(a != b for a, b in zip(segs, batchsegs))))
+
+
+def bench_bestmatch(trainfname="Brown_train_unseg.txt"):
+    """Builds the lexicon on the training file with get_bestmatch and update_lexicon on a dictionary, and with
+    the scores kept in the trie nodes. Both walk the trie the same way, so the difference is the time spent
+    choosing the best match and updating its score"""
+    corpus = data.load_corpus(trainfname)
+    lexicon, dicttime = timed(subtractive.build_lexicon, corpus)
+    scored, scoredtime = timed(subtractive.build_lexicon, corpus, None, True)
+
+    print("utterances: %s\twords: %s" % (len(corpus), len(lexicon)))
+    print("dictionary: %.3fs (%.2f us/utt)\ttrie nodes: %.3fs (%.2f us/utt)" % (dicttime, dicttime/len(corpus)*1e6,
+                                                                              scoredtime, scoredtime/len(corpus)*1e6))
+    print("saved: %.2f us/utt\tspeedup: %.2fx\tsame lexicon: %s" % ((dicttime-scoredtime)/len(corpus)*1e6,
+                                                                   dicttime/scoredtime, lexicon == scored))
+
+
+def bench_segmenters(lexiconfname=None, testfname="Brown_test_unseg.txt", goldfname="Brown_test_gold.txt"):
+    """Reports the throughput in utterances per second and the test F1 of every subtractive segmentation strategy.
+    The lexicon comes from a file written with subtractive.py --save-lexicon, or is built from the training file"""
+    if lexiconfname:
+        index = load_lexicon(lexiconfname)
+    else:
+        index = SyllableTrie.from_lexicon(subtractive.build_lexicon(data.load_corpus("Brown_train_unseg.txt")))
+    corpus = data.load_corpus(testfname)
+    goldmask = data.load_corpus(goldfname).boundaries
+
+    print("strategy\tutt/s\t\tF1")
+    for strategy in sorted(subtractive.SEGMENTERS):
+        mask, elapsed = timed(subtractive.get_segpoints_mask, index, corpus, strategy)
+        print("%s\t\t%.0f\t\t%.2f" % (strategy, len(corpus)/elapsed, data.evaluate_masks(goldmask, mask)[2]*100))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "subtractive":
+        bench_segmenters(*sys.argv[2:])
+    elif len(sys.argv) > 1 and sys.argv[1] == "bestmatch":
+        bench_bestmatch(*sys.argv[2:])
+    else:
+        bench_transprob(*sys.argv[1:])
@@ -1,7 +1,14 @@
-import re
+import re, os, json
+
+import numpy as np
+
+import instrument
 
 syll_rx = re.compile(r"[\.\|]")
 
+# suffix of the directory that holds the compiled form of a data file
+COMPILED_SUFFIX = ".sylc"
+
 def tokenize_syllables(utterance):
     """Tokenizes syllables in the input"""
     return [syll.strip() for syll in syll_rx.split(utterance)]
@@ -17,8 +24,10 @@ def read_file(fname):
         return [line.strip().split("\t")[1] for line in fin if line.strip()]
 
 def get_goldsegs(goldfname):
-    """Returns segmentation points for each utterance in a gold file.
+    """Returns segmentation points for each utterance in a gold file or a compiled SyllableCorpus.
     The segmentation points for each utterance are a list of ints"""
+    if isinstance(goldfname, SyllableCorpus):
+        return goldfname.goldsegs()
     train_utts = read_file(goldfname)
     return [get_boundary_indices(utt) for utt in train_utts]
 
@@ -36,6 +45,189 @@ def apply_boundaries(tokenized, segpoints):
     return " ".join(reconstituted[:-1]) 
 
 
+class SyllableCorpus(object):
+    """A data file stored as one flat array of syllable IDs.
+    Utterance i is ids[offsets[i]:offsets[i+1]], and boundaries[j] is 1 if a word boundary follows syllable j.
+    Iterating over the corpus yields each utterance as a list of syllables, like tokenize_syllables"""
+
+    def __init__(self, vocab, ids, offsets, boundaries):
+        self.vocab = vocab # list of syllable strings, indexed by ID
+        self.ids = ids # int32 array of syllable IDs for the whole corpus
+        self.offsets = offsets # int64 array of utterance start positions in ids, plus the total length at the end
+        self.boundaries = boundaries # uint8 array parallel to ids marking syllables followed by a word boundary
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __iter__(self):
+        vocab = self.vocab
+        ids = self.ids.tolist()
+        offsets = self.offsets.tolist()
+        for start, stop in zip(offsets[:-1], offsets[1:]):
+            yield [vocab[i] for i in ids[start:stop]]
+
+    def utterances(self):
+        """Returns the utterances as unsegmented strings, like read_file on an unsegmented file"""
+        return [" . ".join(sylls) for sylls in self]
+
+    def goldsegs(self):
+        """Returns the set of segmentation points of each utterance, like get_goldsegs"""
+        positions = np.flatnonzero(self.boundaries)
+        utts = np.searchsorted(self.offsets, positions, side="right") - 1
+        segs = [set() for i in range(len(self))]
+        for utt, index in zip(utts.tolist(), (positions - self.offsets[utts]).tolist()):
+            segs[utt].add(index)
+        return segs
+
+    def save(self, dirname):
+        """Writes the corpus to a directory of .npy arrays plus the vocabulary"""
+        os.makedirs(dirname, exist_ok=True)
+        np.save(os.path.join(dirname, "ids.npy"), self.ids)
+        np.save(os.path.join(dirname, "offsets.npy"), self.offsets)
+        np.save(os.path.join(dirname, "boundaries.npy"), self.boundaries)
+        with open(os.path.join(dirname, "vocab.txt"), "w") as fout:
+            fout.write("\n".join(self.vocab))
+
+    @classmethod
+    def load(cls, dirname):
+        """Memory-maps a corpus written by save"""
+        with open(os.path.join(dirname, "vocab.txt"), "r") as fin:
+            vocab = fin.read().split("\n")
+        arrays = [np.load(os.path.join(dirname, name + ".npy"), mmap_mode="r") for name in ("ids", "offsets", "boundaries")]
+        return cls(vocab, *arrays)
+
+
+def compile_corpus(fname):
+    """Reads a data file into a SyllableCorpus. Word boundaries are only marked for gold files"""
+    vocab = {}
+    ids = []
+    offsets = [0]
+    boundaries = []
+    with instrument.stage("tokenize"):
+        for utt in read_file(fname):
+            sylls = tokenize_syllables(utt)
+            segpoints = get_boundary_indices(utt)
+            for i, syll in enumerate(sylls):
+                if syll not in vocab:
+                    vocab[syll] = len(vocab)
+                ids.append(vocab[syll])
+                boundaries.append(1 if i in segpoints else 0)
+            offsets.append(len(ids))
+    if instrument.ENABLED:
+        instrument.count("tokenize.utterances", len(offsets)-1)
+    return SyllableCorpus(list(vocab), np.array(ids, dtype=np.int32), np.array(offsets, dtype=np.int64),
+                          np.array(boundaries, dtype=np.uint8))
+
+
+def load_corpus(fname):
+    """Returns the compiled SyllableCorpus for a data file, memory-mapped from fname + COMPILED_SUFFIX.
+    The file is compiled first if it has no compiled form yet or has changed since it was compiled"""
+    with instrument.stage("load"):
+        dirname = fname + COMPILED_SUFFIX
+        stats = os.stat(fname)
+        source = {"size": stats.st_size, "mtime": stats.st_mtime}
+        try:
+            with open(os.path.join(dirname, "source.json"), "r") as fin:
+                if json.load(fin) == source:
+                    return SyllableCorpus.load(dirname)
+        except (OSError, ValueError):
+            pass
+        compile_corpus(fname).save(dirname)
+        with open(os.path.join(dirname, "source.json"), "w") as fout:
+            json.dump(source, fout)
+        return SyllableCorpus.load(dirname)
+
+
+def iter_tokenized(utts):
+    """Yields each utterance as a list of syllables, from a SyllableCorpus or a list of utterance strings
+    or already tokenized utterances"""
+    if isinstance(utts, SyllableCorpus):
+        yield from utts
+        return
+    for utt in utts:
+        if isinstance(utt, list):
+            yield utt
+        else:
+            yield tokenize_syllables(utt) if utt.strip() else []
+
+
+
+# utterance length buckets (in syllables) for evaluate_breakdown. The last bucket is open-ended
+LENGTH_BUCKETS = (1, 2, 3, 5, 9, 17)
+
+
+def segs_to_mask(allsegs, offsets):
+    """Converts a list of segmentation point sets into a boundary mask laid out like SyllableCorpus.boundaries"""
+    mask = np.zeros(int(offsets[-1]), dtype=np.uint8)
+    positions = [start + index for start, segs in zip(offsets[:-1].tolist(), allsegs) for index in segs]
+    mask[positions] = 1
+    return mask
+
+
+def mask_to_segs(mask, offsets):
+    """Converts a boundary mask back into a list of segmentation point sets, one per utterance"""
+    return SyllableCorpus([], np.zeros(0, dtype=np.int32), offsets, mask).goldsegs()
+
+
+def get_prf(truepos, numpred, numgold):
+    """Precision, recall and F1 from true positive, predicted and gold boundary counts.
+    Works elementwise on arrays. Each score is 0 where its denominator is 0"""
+    truepos, numpred, numgold = (np.asarray(count, dtype=float) for count in (truepos, numpred, numgold))
+    P = np.divide(truepos, numpred, out=np.zeros_like(truepos), where=numpred > 0)
+    R = np.divide(truepos, numgold, out=np.zeros_like(truepos), where=numgold > 0)
+    F1 = np.divide(2*P*R, P+R, out=np.zeros_like(P), where=P+R > 0)
+    return P, R, F1
+
+
+def evaluate_masks(goldmask, predmask):
+    """Computes precision, recall, and f1 of the entire corpus from parallel boundary masks
+    input:
+        goldmask (array): 1 where a gold word boundary follows a syllable, laid out like SyllableCorpus.boundaries
+        predmask (array): 1 where a predicted word boundary follows a syllable
+    return:
+        (float): Precision
+        (float): Recall
+        (float): F1-Score
+    """
+    with instrument.stage("evaluate"):
+        goldmask = np.asarray(goldmask, dtype=bool)
+        predmask = np.asarray(predmask, dtype=bool)
+        return tuple(float(stat) for stat in get_prf(np.count_nonzero(goldmask & predmask), np.count_nonzero(predmask), np.count_nonzero(goldmask)))
+
+
+def evaluate_breakdown(goldmask, predmask, offsets, buckets=LENGTH_BUCKETS):
+    """Scores boundary masks for the corpus, each utterance and each utterance length bucket in one pass
+    input:
+        goldmask (array): gold boundary mask
+        predmask (array): predicted boundary mask
+        offsets (array): utterance offsets into the masks, as in SyllableCorpus.offsets
+        buckets (seq): ascending lower bounds of the length buckets, in syllables
+    return:
+        (dict): "corpus" is (P, R, F1). "utterances" is (P, R, F1) arrays with one entry per utterance.
+                "buckets" is a list of (lower bound, upper bound or None, number of utterances, P, R, F1)
+    """
+    goldmask = np.asarray(goldmask, dtype=np.int64)
+    predmask = np.asarray(predmask, dtype=np.int64)
+    offsets = np.asarray(offsets)
+    starts = offsets[:-1]
+    if len(starts):
+        counts = [np.add.reduceat(mask, starts) for mask in (goldmask & predmask, predmask, goldmask)]
+    else:
+        counts = [np.zeros(0, dtype=np.int64)] * 3
+    lengths = np.diff(offsets)
+    bucketids = np.searchsorted(buckets, lengths, side="right") - 1
+    bucketcounts = [np.bincount(bucketids[bucketids >= 0], weights=count[bucketids >= 0], minlength=len(buckets))
+                    for count in counts]
+    numutts = np.bincount(bucketids[bucketids >= 0], minlength=len(buckets))
+    bucketstats = get_prf(*bucketcounts)
+    uppers = list(buckets[1:]) + [None]
+    return {
+        "corpus": tuple(float(stat) for stat in get_prf(*(count.sum() for count in counts))),
+        "utterances": get_prf(*counts),
+        "buckets": [(buckets[i], uppers[i], int(numutts[i])) + tuple(float(stat[i]) for stat in bucketstats)
+                    for i in range(len(buckets))],
+    }
+
 
 ###
 ### YOUR FUNCTIONS
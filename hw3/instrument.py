@@ -0,0 +1,140 @@
+import os, time, json, atexit
+from contextlib import contextmanager
+
+# environment variable that turns instrumentation on. Its value is the report file, or 1 for DEFAULT_REPORT
+ENV_VAR = "LIN220_PROFILE"
+DEFAULT_REPORT = "profile.json"
+
+ENABLED = False # checked by the instrumented code before recording anything
+REPORT = None # file the report is written to when the program exits
+COUNTERS = {} # name : total
+TIMERS = {} # stage : total seconds, including the time of any stages nested inside it
+ACTIVE = set() # stages being timed right now, so a stage nested in itself is only timed once
+SERIES = {} # name : list of [x, y] samples
+
+
+def enable(reportfname=DEFAULT_REPORT):
+    """Turns instrumentation on and writes the report to reportfname when the program exits"""
+    global ENABLED, REPORT
+    if REPORT is None:
+        atexit.register(write_report)
+    ENABLED = True
+    REPORT = reportfname
+
+
+def reset():
+    """Forgets everything recorded so far"""
+    COUNTERS.clear()
+    TIMERS.clear()
+    SERIES.clear()
+
+
+def count(name, n=1):
+    """Adds n to a counter. Hot loops should check ENABLED first rather than call this unconditionally"""
+    COUNTERS[name] = COUNTERS.get(name, 0) + n
+
+
+def sample(name, x, y):
+    """Records one point of a series, e.g. the lexicon size after x utterances"""
+    SERIES.setdefault(name, []).append([x, y])
+
+
+class CountingDict(dict):
+    """Dictionary that adds every read of a key, by indexing, get, setdefault or in, to a counter.
+    Stands in for a dictionary handed to code whose lookups should be counted"""
+
+    def __init__(self, countername, *args):
+        dict.__init__(self, *args)
+        self.countername = countername # counter the lookups are added to
+
+    def __getitem__(self, key):
+        count(self.countername)
+        return dict.__getitem__(self, key)
+
+    def get(self, key, default=None):
+        count(self.countername)
+        return dict.get(self, key, default)
+
+    def setdefault(self, key, default=None):
+        count(self.countername)
+        return dict.setdefault(self, key, default)
+
+    def __contains__(self, key):
+        count(self.countername)
+        return dict.__contains__(self, key)
+
+
+@contextmanager
+def timed_stage(name):
+    if name in ACTIVE:
+        yield
+        return
+    ACTIVE.add(name)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        TIMERS[name] = TIMERS.get(name, 0.0) + time.perf_counter() - start
+        ACTIVE.discard(name)
+
+
+# shared no-op context for stages while instrumentation is off
+class NullStage(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+NULL_STAGE = NullStage()
+
+
+def stage(name):
+    """Context manager that adds the time spent inside it to the timer of a stage such as load, tokenize,
+    train, segment or evaluate. Does nothing while instrumentation is off"""
+    return timed_stage(name) if ENABLED else NULL_STAGE
+
+
+def snapshot():
+    """returns everything recorded so far as a JSON-serializable dictionary"""
+    return {"counters": dict(COUNTERS), "timers": dict(TIMERS), "series": dict((name, list(points)) for name, points in SERIES.items())}
+
+
+def merge(other):
+    """Adds a snapshot from another process to what this process has recorded"""
+    for name, n in other["counters"].items():
+        count(name, n)
+    for name, seconds in other["timers"].items():
+        TIMERS[name] = TIMERS.get(name, 0.0) + seconds
+    for name, points in other["series"].items():
+        SERIES.setdefault(name, []).extend(points)
+
+
+def get_report():
+    """returns the snapshot plus derived rates: utterances per second for every stage with a
+    "<stage>.utterances" counter, and the average number of candidates per subtraction step"""
+    report = snapshot()
+    rates = {}
+    for name, seconds in TIMERS.items():
+        utts = COUNTERS.get(name + ".utterances")
+        if utts and seconds:
+            rates[name] = utts / seconds
+    report["utterances_per_second"] = rates
+    steps = COUNTERS.get("train.subtraction_steps")
+    if steps:
+        report["candidates_per_step"] = COUNTERS.get("train.candidates", 0) / steps
+    return report
+
+
+def write_report(fname=None):
+    """Writes the report as JSON to fname, or to the file given to enable"""
+    fname = fname or REPORT
+    if fname is None:
+        return
+    with open(fname, "w") as fout:
+        json.dump(get_report(), fout, indent=1, sort_keys=True)
+
+
+if os.environ.get(ENV_VAR):
+    enable(DEFAULT_REPORT if os.environ[ENV_VAR] == "1" else os.environ[ENV_VAR])
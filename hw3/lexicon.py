@@ -0,0 +1,281 @@
+import json, struct, bisect
+
+import numpy as np
+
+import data
+
+
+def join_syllables(sylls):
+    """Joins a sequence of syllables into a word string in the same format as the data files"""
+    return " . ".join(sylls)
+
+
+class TrieNode(object):
+    """Object representing one syllable position in a SyllableTrie"""
+
+    def __init__(self):
+        self.children = {} # dictionary of syllable : TrieNode
+        self.word = None # word string ending at this node, None if no lexicon word ends here
+        self.score = 0 # lexicon score of that word
+        self.length = 0 # number of syllables from the root to this node
+
+
+class SyllableTrie(object):
+    """Lexicon words indexed syllable by syllable, so every word matching the start
+    of an utterance can be found in a single walk instead of by slicing strings"""
+
+    def __init__(self):
+        self.root = TrieNode()
+        self.size = 0 # number of words stored
+        self.total = 0 # sum of the scores of all words stored
+
+    @classmethod
+    def from_lexicon(cls, lexicon):
+        """Indexes every word in a lexicon dictionary of word : score, keeping the scores"""
+        trie = cls()
+        for word, score in lexicon.items():
+            trie.add(data.tokenize_syllables(word), score)
+        return trie
+
+    def add(self, sylls, score=0):
+        """Adds the word made up of the syllables in sylls if it is new, and score to its score. Returns the word string"""
+        node = self.root
+        for syll in sylls:
+            if syll not in node.children:
+                node.children[syll] = TrieNode()
+                node.children[syll].length = node.length + 1
+            node = node.children[syll]
+        if node.word is None:
+            node.word = join_syllables(sylls)
+            self.size += 1
+        node.score += score
+        self.total += score
+        return node.word
+
+    def prefixes(self, sylls, start, stop):
+        """Yields (number of syllables, word) for every word that matches sylls from index start,
+        shortest first, considering only words that end before index stop"""
+        node = self.root
+        for i in range(start, stop):
+            node = node.children.get(sylls[i])
+            if node is None:
+                return
+            if node.word is not None:
+                yield i + 1 - start, node.word
+
+    def prefix_nodes(self, sylls, start, stop):
+        """Like prefixes, but yields the TrieNode of each word so its score can be compared and updated in place"""
+        node = self.root
+        for i in range(start, stop):
+            node = node.children.get(sylls[i])
+            if node is None:
+                return
+            if node.word is not None:
+                yield node
+
+    def prefix_scores(self, sylls, start, stop):
+        """Like prefixes, but yields (number of syllables, score) without building word strings"""
+        node = self.root
+        for i in range(start, stop):
+            node = node.children.get(sylls[i])
+            if node is None:
+                return
+            if node.word is not None:
+                yield i + 1 - start, node.score
+
+    def to_lexicon(self):
+        """returns the stored words as a lexicon dictionary of word : score"""
+        lexicon = {}
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            if node.word is not None:
+                lexicon[node.word] = node.score
+            stack.extend(node.children.values())
+        return lexicon
+
+    def __contains__(self, word):
+        node = self.root
+        for syll in data.tokenize_syllables(word):
+            node = node.children.get(syll)
+            if node is None:
+                return False
+        return node.word is not None
+
+    def __len__(self):
+        return self.size
+
+
+# first bytes of a lexicon file written by save_lexicon
+LEXICON_MAGIC = b"SYLLEX01"
+
+
+def save_lexicon(lexicon, fname):
+    """Writes a lexicon dictionary of word : score or a LexiconArtifact to a single binary file that load_lexicon
+    can memory-map. The file holds a JSON header with the syllable vocabulary, followed by the lexicon as a trie in
+    breadth-first order: the children of node n are the nodes child_starts[n] up to child_starts[n+1],
+    sorted by the syllable ID in labels, and scores[n] is the score of the word ending at node n, or 0"""
+    trie = SyllableTrie.from_lexicon(lexicon)
+    vocab = sorted(set(syll for word in lexicon for syll in data.tokenize_syllables(word)))
+    sylids = dict((syll, i) for i, syll in enumerate(vocab))
+    child_starts = [1]
+    labels = [-1]
+    scores = [0]
+    queue = [trie.root]
+    for node in queue:
+        for syll in sorted(node.children, key=sylids.get):
+            child = node.children[syll]
+            labels.append(sylids[syll])
+            scores.append(lexicon[child.word] if child.word is not None else 0)
+            queue.append(child)
+        child_starts.append(len(labels))
+    arrays = {"child_starts": np.array(child_starts, dtype=np.int32),
+              "labels": np.array(labels, dtype=np.int32),
+              "scores": np.array(scores, dtype=np.int64)}
+
+    header = {"vocab": vocab, "size": len(trie), "arrays": {}}
+    offset = 0
+    for name, array in arrays.items():
+        header["arrays"][name] = [array.dtype.str, len(array), offset]
+        offset += array.nbytes
+    headerbytes = json.dumps(header).encode("utf-8")
+    # pads the header so the arrays start on an 8 byte boundary
+    headerbytes += b" " * (-len(headerbytes) % 8)
+    with open(fname, "wb") as fout:
+        fout.write(LEXICON_MAGIC)
+        fout.write(struct.pack("<Q", len(headerbytes)))
+        fout.write(headerbytes)
+        for array in arrays.values():
+            fout.write(array.tobytes())
+
+
+def load_lexicon(fname):
+    """Memory-maps a lexicon file written by save_lexicon. Returns a LexiconArtifact"""
+    with open(fname, "rb") as fin:
+        if fin.read(len(LEXICON_MAGIC)) != LEXICON_MAGIC:
+            raise ValueError("%s is not a lexicon file" % fname)
+        headerlen = struct.unpack("<Q", fin.read(8))[0]
+        header = json.loads(fin.read(headerlen).decode("utf-8"))
+    start = len(LEXICON_MAGIC) + 8 + headerlen
+    arrays = {}
+    for name, (dtype, length, offset) in header["arrays"].items():
+        arrays[name] = np.memmap(fname, dtype=dtype, mode="r", offset=start+offset, shape=(length,)) if length else np.zeros(0, dtype=dtype)
+    return LexiconArtifact(header["vocab"], header["size"], **arrays)
+
+
+class LexiconArtifact(object):
+    """Read-only lexicon backed by the memory-mapped arrays of a file written by save_lexicon.
+    It can be used wherever a SyllableTrie is accepted, and looked up like a dictionary of word : score"""
+
+    def __init__(self, vocab, size, child_starts, labels, scores):
+        self.vocab = vocab # ID : syllable
+        self.sylids = dict((syll, i) for i, syll in enumerate(vocab)) # syllable : ID
+        self.size = size # number of words stored
+        self.total = int(scores.sum()) # sum of the scores of all words stored
+        self.arrays = (child_starts, labels, scores) # keeps the memory maps open
+        # memoryviews are much cheaper to index from Python than the arrays themselves
+        self.child_starts = memoryview(child_starts).cast("B").cast("i")
+        self.labels = memoryview(labels).cast("B").cast("i")
+        self.scores = memoryview(scores).cast("B").cast("q")
+
+    def find_child(self, node, syll):
+        """returns the child of node reached by syllable syll, or None"""
+        sylid = self.sylids.get(syll)
+        if sylid is None:
+            return None
+        lo, hi = self.child_starts[node], self.child_starts[node+1]
+        i = bisect.bisect_left(self.labels, sylid, lo, hi)
+        return i if i < hi and self.labels[i] == sylid else None
+
+    def prefixes(self, sylls, start, stop):
+        """Yields (number of syllables, word) for every word that matches sylls from index start,
+        shortest first, considering only words that end before index stop"""
+        node = 0
+        for i in range(start, stop):
+            node = self.find_child(node, sylls[i])
+            if node is None:
+                return
+            if self.scores[node]:
+                yield i + 1 - start, join_syllables(sylls[start:i+1])
+
+    def prefix_scores(self, sylls, start, stop):
+        """Like prefixes, but yields (number of syllables, score) without building word strings"""
+        node = 0
+        for i in range(start, stop):
+            node = self.find_child(node, sylls[i])
+            if node is None:
+                return
+            if self.scores[node]:
+                yield i + 1 - start, self.scores[node]
+
+    def get(self, word, default=None):
+        """returns the score of word, or default if it isn't in the lexicon"""
+        node = 0
+        for syll in data.tokenize_syllables(word):
+            node = self.find_child(node, syll)
+            if node is None:
+                return default
+        return self.scores[node] or default
+
+    def items(self):
+        """Yields (word, score) for every word stored, so an artifact can be saved again or turned into a dictionary"""
+        stack = [(0, [])]
+        while stack:
+            node, sylls = stack.pop()
+            if self.scores[node]:
+                yield join_syllables(sylls), self.scores[node]
+            for child in range(self.child_starts[node], self.child_starts[node+1]):
+                stack.append((child, sylls + [self.vocab[self.labels[child]]]))
+
+    def __iter__(self):
+        return (word for word, score in self.items())
+
+    def __getitem__(self, word):
+        score = self.get(word)
+        if score is None:
+            raise KeyError(word)
+        return score
+
+    def __contains__(self, word):
+        return self.get(word) is not None
+
+    def __len__(self):
+        return self.size
+
+
+def dict_prefixes(lexicon, sylls, start, stop):
+    """Like SyllableTrie.prefixes for a lexicon dictionary of word : score, probing it with every candidate word"""
+    for end in range(start+1, stop+1):
+        candidate = join_syllables(sylls[start:end])
+        if candidate in lexicon:
+            yield end - start, candidate
+
+
+class DictLexicon(object):
+    """Lexicon dictionary of word : score with the same prefix lookups as a SyllableTrie, done by probing the
+    dictionary with every candidate word. The total score is summed once when it is wrapped, so wrap a
+    dictionary once rather than for every utterance"""
+
+    def __init__(self, lexicon):
+        self.lexicon = lexicon # dictionary of word : score
+        self.total = sum(lexicon.values()) # sum of the scores of all words
+
+    def prefixes(self, sylls, start, stop):
+        """Yields (number of syllables, word) for every word that matches sylls from index start,
+        shortest first, considering only words that end before index stop"""
+        return dict_prefixes(self.lexicon, sylls, start, stop)
+
+    def prefix_scores(self, sylls, start, stop):
+        """Like prefixes, but yields (number of syllables, score)"""
+        for length, word in dict_prefixes(self.lexicon, sylls, start, stop):
+            yield length, self.lexicon[word]
+
+    def __contains__(self, word):
+        return word in self.lexicon
+
+    def __len__(self):
+        return len(self.lexicon)
+
+
+# lexicon objects that get_utt_segpoints can use without indexing them first
+INDEX_TYPES = (SyllableTrie, LexiconArtifact, DictLexicon)
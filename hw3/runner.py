@@ -0,0 +1,136 @@
+import time, argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import data
+import instrument
+import baseline
+import transprob
+import subtractive
+
+# data files for each split, as (unsegmented, gold)
+SPLITS = (("Training", "Brown_train_unseg.txt", "Brown_train_gold.txt"),
+          ("Testing", "Brown_test_unseg.txt", "Brown_test_gold.txt"))
+
+# corpora of the current process, loaded once by load_data
+CORPORA = {}
+
+
+def load_data():
+    """Memory-maps the unsegmented corpus and the gold boundary mask of every split, once per process.
+    returns a dictionary of split title : (SyllableCorpus, gold boundary mask)"""
+    if not CORPORA:
+        for title, uttfname, goldfname in SPLITS:
+            CORPORA[title] = (data.load_corpus(uttfname), data.load_corpus(goldfname).boundaries)
+    return CORPORA
+
+
+def train_nothing(utts):
+    return None
+
+
+def segment_baseline(model, utts):
+    return baseline.baseline_segs(list(utts))
+
+
+def segment_transprob(probdict, utts):
+    return transprob.get_segpoints(list(utts), probdict)
+
+
+def segment_transprob_batch(model, utts):
+    return transprob.get_batch_segpoints(utts, model)
+
+
+def train_subtractive_scored(utts):
+    return subtractive.build_lexicon(utts, scored=True)
+
+
+def segment_subtractive(lexicon, utts):
+    return subtractive.get_segpoints_strategy(lexicon, utts)[1]
+
+
+def segment_subtractive_viterbi(lexicon, utts):
+    return subtractive.get_segpoints_strategy(lexicon, utts, "viterbi")[1]
+
+
+# segmenters the runner can compare, as (function training a model on the training SyllableCorpus,
+# function segmenting a SyllableCorpus with that model into segmentation point sets or a boundary mask)
+SEGMENTERS = {"baseline": (train_nothing, segment_baseline),
+              "transprob": (transprob.get_bigramprobdict, segment_transprob),
+              "transprob-batch": (transprob.BigramModel.from_utterances, segment_transprob_batch),
+              "subtractive": (subtractive.build_lexicon, segment_subtractive),
+              "subtractive-scored": (train_subtractive_scored, segment_subtractive),
+              "subtractive-viterbi": (subtractive.build_lexicon, segment_subtractive_viterbi)}
+
+
+def run_segmenter(name):
+    """Trains one of SEGMENTERS and segments every split with it, using the corpora of this process.
+    returns (dictionary of split title : boundary mask, dictionary of stage : seconds, instrumentation snapshot or None)"""
+    train, segment = SEGMENTERS[name]
+    corpora = load_data()
+    # workers start with whatever their parent or earlier tasks recorded
+    instrument.reset()
+    start = time.perf_counter()
+    with instrument.stage("train"):
+        model = train(corpora["Training"][0])
+    timings = {"train": time.perf_counter() - start}
+    masks = {}
+    for title, (utts, goldmask) in corpora.items():
+        start = time.perf_counter()
+        with instrument.stage("segment"):
+            segs = segment(model, utts)
+        if instrument.ENABLED:
+            instrument.count("segment.utterances", len(utts))
+        masks[title] = segs if hasattr(segs, "dtype") else data.segs_to_mask(segs, utts.offsets)
+        timings[title] = time.perf_counter() - start
+    return masks, timings, instrument.snapshot() if instrument.ENABLED else None
+
+
+def main(names, numworkers=None):
+    start = time.perf_counter()
+    corpora = load_data()
+    loadtime = time.perf_counter() - start
+
+    results = {}
+    # Workers are forked after loading, so they share the memory-mapped corpora instead of loading them again
+    with ProcessPoolExecutor(numworkers) as pool:
+        futures = dict((name, pool.submit(run_segmenter, name)) for name in names)
+        for name, future in futures.items():
+            try:
+                results[name] = future.result()
+            except Exception as err:
+                results[name] = err
+                continue
+            if results[name][2]:
+                instrument.merge(results[name][2])
+
+    print("Loaded the corpora in %.3fs\n" % loadtime)
+    print("Segmenter\t\tSplit\t\tP\tR\tF1\tTrain (s)\tSegment (s)\tEvaluate (s)")
+    for name in names:
+        if isinstance(results[name], Exception):
+            print("%s\tfailed: %r" % (name.ljust(16), results[name]))
+            continue
+        masks, timings, snapshot = results[name]
+        for title, (utts, goldmask) in corpora.items():
+            start = time.perf_counter()
+            stats = data.evaluate_masks(goldmask, masks[title])
+            evaltime = time.perf_counter() - start
+            print("%s\t%s\t%s\t%s\t%s\t%.3f\t\t%.3f\t\t%.4f" % ((name.ljust(16), title.ljust(8)) + tuple([round(stat*100, 2) for stat in stats])
+                                                                   + (timings["train"], timings[title], evaltime)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    # choices can't be combined with a list default for nargs="*", so the names are checked after parsing
+    parser.add_argument("segmenters", nargs="*", default=None,
+                        help="segmenters to compare, from %s (default: all of them)" % ", ".join(sorted(SEGMENTERS)))
+    parser.add_argument("--workers", type=int, default=None, help="processes to run the segmenters in (default: all cores)")
+    parser.add_argument("--profile", nargs="?", const=instrument.DEFAULT_REPORT, default=None,
+                        help="record counters and stage timings of all segmenters and write them to this JSON file (also set by %s)" % instrument.ENV_VAR)
+    args = parser.parse_args()
+    names = args.segmenters or sorted(SEGMENTERS)
+    unknown = [name for name in names if name not in SEGMENTERS]
+    if unknown:
+        parser.error("unknown segmenters: %s (choose from %s)" % (", ".join(unknown), ", ".join(sorted(SEGMENTERS))))
+    if args.profile:
+        instrument.enable(args.profile)
+    main(names, args.workers)
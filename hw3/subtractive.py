@@ -1,61 +1,229 @@
 import data
-import re
-
-def build_lexicon(utts):
-    """The core lexicon-building algorithm. Returns a dictionary of words with their scores"""
-    lexicon = {}
-    for utt in utts:
-        # Subtraction loop
-        remainder = utt
-        while remainder:
-            # Get all the possible subtractions
-            matchedwords = set()
-            syllindices = [i for i, syllseg in enumerate(remainder) if syllseg == "."]
-            for i in syllindices:
-                candidate = remainder[:i].strip()
-                if candidate in lexicon:
-                    matchedwords.add(candidate)
-            # Do subtraction and lexicon updating
-            if matchedwords: # If at least one subtraction is found
-                # Get the best one
-                beststartword = get_bestmatch(matchedwords, lexicon)
-                # Do the subtraction
-                remainder = subtract(beststartword, remainder)
-                # Update the subtracted word in the lexicon
-                update_lexicon(lexicon, beststartword)
-            else: # No subtraction was found
-                # Update the lexicon with the remained and move to the next word
-                update_lexicon(lexicon, remainder)
-                break
-    return lexicon
+import instrument
+import re, math, random, argparse
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from itertools import repeat
+from lexicon import SyllableTrie, DictLexicon, INDEX_TYPES, dict_prefixes, join_syllables, save_lexicon, load_lexicon
+
+# number of utterances between samples of the lexicon size when instrumentation is on
+GROWTH_SAMPLE_EVERY = 1000
+
+
+def build_lexicon(utts, lexicon=None, scored=False):
+    """The core lexicon-building algorithm. Returns a dictionary of words with their scores.
+    If a starting lexicon is given, a copy of it is updated instead of starting from scratch.
+    With scored, the scores live in the trie nodes alongside each word's syllable length, and get_bestnode
+    and an increment on the node stand in for get_bestmatch and update_lexicon. The lexicon is the same"""
+    # Checked once, so the loop costs nothing extra when instrumentation is off
+    profiling = instrument.ENABLED
+    # counts every lookup get_bestmatch and update_lexicon make when profiling
+    lexicon = instrument.CountingDict("train.lexicon_lookups", lexicon or {}) if profiling else dict(lexicon or {})
+    with instrument.stage("train"):
+        # Index of the lexicon words for finding subtractions in one walk
+        trie = SyllableTrie.from_lexicon(lexicon)
+        for numutts, sylls in enumerate(data.iter_tokenized(utts), 1):
+            # Subtraction loop. The remainder is everything from pos onwards
+            pos = 0
+            while pos < len(sylls):
+                if scored:
+                    # Every word matching the remainder, without taking up all of it, with its score and length
+                    nodes = list(trie.prefix_nodes(sylls, pos, len(sylls)-1))
+                    if profiling:
+                        instrument.count("train.subtraction_steps")
+                        instrument.count("train.candidates", len(nodes))
+                    if nodes:
+                        best = get_bestnode(nodes)
+                        pos += best.length
+                        best.score += 1
+                        trie.total += 1
+                    else:
+                        trie.add(sylls[pos:], 1)
+                        break
+                    continue
+                # Get all the possible subtractions. They can't take up the whole remainder
+                matchedwords = dict((word, length) for length, word in trie.prefixes(sylls, pos, len(sylls)-1))
+                if profiling:
+                    instrument.count("train.subtraction_steps")
+                    instrument.count("train.candidates", len(matchedwords))
+                # Do subtraction and lexicon updating
+                if matchedwords: # If at least one subtraction is found
+                    # Get the best one
+                    beststartword = get_bestmatch(set(matchedwords), lexicon)
+                    # Do the subtraction
+                    pos += matchedwords[beststartword]
+                    # Update the subtracted word in the lexicon
+                    update_lexicon(lexicon, beststartword)
+                else: # No subtraction was found
+                    # Update the lexicon with the remained and move to the next word
+                    update_lexicon(lexicon, trie.add(sylls[pos:]))
+                    break
+            if profiling:
+                instrument.count("train.utterances")
+                if numutts % GROWTH_SAMPLE_EVERY == 0:
+                    instrument.sample("lexicon_size", numutts, len(trie) if scored else len(lexicon))
+    return trie.to_lexicon() if scored else dict(lexicon)
+
+
+def get_bestnode(nodes):
+    """returns the TrieNode with the highest score, or the one with the fewest syllables if several are tied,
+    the same choice get_bestmatch makes among their words"""
+    best = nodes[0]
+    for node in nodes[1:]:
+        if node.score > best.score or (node.score == best.score and node.length < best.length):
+            best = node
+    return best
 
 
 def get_utt_segpoints(lexicon, utt):
     """Actually segments an utterance given the lexicon. 
-    Returns the segmented utterance and a set of segmentation points"""
-    remainder = utt
+    Returns the segmented utterance and a set of segmentation points.
+    The utterance can be a string or a list of syllables.
+    The lexicon can be a SyllableTrie, a LexiconArtifact, a DictLexicon or a dictionary, which is probed
+    word by word. Index a dictionary with SyllableTrie.from_lexicon first to segment many utterances faster"""
+    prefixes = lexicon.prefixes if isinstance(lexicon, INDEX_TYPES) else partial(dict_prefixes, lexicon)
+    sylls = utt if isinstance(utt, list) else next(data.iter_tokenized([utt]))
     wordseq = []
+    segpoints = set()
+    pos = 0
     # Loop to subtract utterance-initial words
-    while remainder:
-        syllindices = [i for i, syllseg in enumerate(remainder) if syllseg == "."]
-        found = False
-        for i in syllindices:
-            candidate = remainder[:i].strip()
-            # Subtract the shortest possible word
-            if candidate in lexicon:
-                # Do the subtraction
-                remainder = subtract(candidate, remainder)
-                # Add
-                wordseq.append(candidate)
-                found = True
-                break
+    while pos < len(sylls):
+        # Subtract the shortest possible word
+        for length, candidate in prefixes(sylls, pos, len(sylls)-1):
+            wordseq.append(candidate)
+            pos += length
+            segpoints.add(pos-1)
+            break
         # Give up when nothing left can be subtracted
-        if not found:
-            wordseq.append(remainder)
+        else:
+            wordseq.append(join_syllables(sylls[pos:]))
             break
     # Reconstitute the utterance with word boundaries
-    joined = " | ".join(wordseq)
-    return joined, data.get_boundary_indices(joined)
+    return " | ".join(wordseq), segpoints
+
+
+# longest word in syllables considered by get_utt_segpoints_viterbi
+MAX_WORD_SYLLS = 8
+# log probability per syllable of a span that isn't in the lexicon, lower than any lexicon word's
+UNK_LOGPROB = -15.0
+
+
+def get_utt_segpoints_viterbi(lexicon, utt, maxlen=MAX_WORD_SYLLS, unklogprob=UNK_LOGPROB):
+    """Segments an utterance into the sequence of words with the highest total log relative frequency in the lexicon.
+    Spans of up to maxlen syllables that aren't lexicon words can still be used at unklogprob per syllable,
+    so every utterance has a segmentation. Runs in time linear in the utterance length for a fixed maxlen.
+    Takes the same arguments and returns the same values as get_utt_segpoints. A dictionary lexicon is summed
+    for its total on every call, so wrap it in a DictLexicon or a SyllableTrie once to segment many utterances"""
+    trie = lexicon if isinstance(lexicon, INDEX_TYPES) else DictLexicon(lexicon)
+    sylls = utt if isinstance(utt, list) else next(data.iter_tokenized([utt]))
+    n = len(sylls)
+    logtotal = math.log(trie.total) if trie.total else 0.0
+    # best[i] is the score of the best segmentation of sylls[:i], and back[i] the start of its last word
+    best = [0.0] + [-math.inf] * n
+    back = [0] * (n+1)
+    for start in range(n):
+        base = best[start]
+        # Unknown spans first, so an equally good lexicon word replaces them
+        for end in range(start+1, min(n, start+maxlen)+1):
+            score = base + unklogprob * (end-start)
+            # Ties go to the earlier start, which means fewer, longer words
+            if score > best[end]:
+                best[end] = score
+                back[end] = start
+        for length, wordscore in trie.prefix_scores(sylls, start, min(n, start+maxlen)):
+            score = base + math.log(wordscore) - logtotal
+            if score >= best[start+length]:
+                best[start+length] = score
+                back[start+length] = start
+    # Follow the back pointers from the end of the utterance
+    ends = []
+    end = n
+    while end > 0:
+        ends.append(end)
+        end = back[end]
+    ends.reverse()
+    wordseq = [join_syllables(sylls[start:end]) for start, end in zip([0] + ends[:-1], ends)]
+    return " | ".join(wordseq), set(end-1 for end in ends[:-1])
+
+
+# segmentation strategies for get_segpoints_strategy and get_segpoints_mask, each taking a lexicon and an utterance
+SEGMENTERS = {"greedy": get_utt_segpoints,
+              "viterbi": get_utt_segpoints_viterbi}
+
+
+def get_shards(numutts, numshards, seed):
+    """Splits the utterance indices into numshards contiguous shards of nearly equal size.
+    The indices are shuffled with seed first, unless seed is None"""
+    indices = list(range(numutts))
+    if seed is not None:
+        random.Random(seed).shuffle(indices)
+    q, r = divmod(numutts, numshards)
+    bounds = [q*i + min(i, r) for i in range(numshards+1)]
+    return [indices[start:stop] for start, stop in zip(bounds[:-1], bounds[1:])]
+
+
+def merge_lexicons(lexicons):
+    """Adds up the scores of several lexicons, in order"""
+    merged = {}
+    for lexicon in lexicons:
+        for word, score in lexicon.items():
+            merged[word] = merged.get(word, 0) + score
+    return merged
+
+
+def build_lexicon_sharded(utts, numshards, numworkers=None, seed=0, reconcile=False, scored=False):
+    """Approximates build_lexicon by building partial lexicons on shards of the corpus in a process pool
+    and adding up their scores. With reconcile, every shard is processed a second time starting from the
+    merged lexicon. The final scores are then the subtractions counted in that second pass, and words it
+    never subtracted keep a score of 1. The same seed and number of shards always gives the same lexicon.
+    scored is passed on to build_lexicon"""
+    tokenizeds = list(data.iter_tokenized(utts))
+    shards = [[tokenizeds[i] for i in shard] for shard in get_shards(len(tokenizeds), numshards, seed)]
+    with ProcessPoolExecutor(numworkers) as pool:
+        merged = merge_lexicons(pool.map(build_lexicon, shards, repeat(None), repeat(scored)))
+        if not reconcile:
+            return merged
+        reconciled = list(pool.map(build_lexicon, shards, repeat(merged), repeat(scored)))
+    deltas = merge_lexicons({word: score - merged.get(word, 0) for word, score in lexicon.items()} for lexicon in reconciled)
+    return dict((word, deltas.get(word, 0) or 1) for word in list(merged) + list(deltas))
+
+
+def get_lexicon_drift(reference, approx):
+    """Compares an approximate lexicon to a reference one
+    returns (dict): "shared" words in both, "jaccard" similarity of the word sets, and "score_drift", the total absolute
+                    score difference as a fraction of the reference's total score"""
+    shared = set(reference) & set(approx)
+    union = set(reference) | set(approx)
+    scorediff = sum(abs(reference.get(word, 0) - approx.get(word, 0)) for word in union)
+    return {"shared": len(shared),
+            "jaccard": len(shared) / len(union) if union else 1.0,
+            "score_drift": scorediff / sum(reference.values()) if reference else 0.0}
+
+
+def get_segpoints_strategy(lexicon, utts, strategy="greedy"):
+    """Like get_segpoints, but segments with the SEGMENTERS strategy. "greedy" is the assignment's get_segpoints,
+    which is given a plain dictionary and utterance strings, as its spec says. The lexicon can be a dictionary
+    or a LexiconArtifact, and the utterances a list of strings or a SyllableCorpus"""
+    if strategy == "greedy":
+        lexicon = lexicon if isinstance(lexicon, dict) else dict(lexicon.items())
+        utts = utts.utterances() if isinstance(utts, data.SyllableCorpus) else utts
+        return get_segpoints(lexicon, utts)
+    segmenter = SEGMENTERS[strategy]
+    # Index the lexicon once so segmenting doesn't rescan it for every utterance
+    index = lexicon if isinstance(lexicon, INDEX_TYPES) else SyllableTrie.from_lexicon(lexicon)
+    results = [segmenter(index, utt) for utt in utts]
+    return [joined for joined, segs in results], [segs for joined, segs in results]
+
+
+def get_segpoints_mask(lexicon, corpus, strategy="greedy"):
+    """Segments every utterance of a SyllableCorpus with the SEGMENTERS strategy and returns a boundary mask"""
+    index = lexicon if isinstance(lexicon, INDEX_TYPES) else SyllableTrie.from_lexicon(lexicon)
+    segmenter = SEGMENTERS[strategy]
+    with instrument.stage("segment"):
+        allsegs = [segmenter(index, sylls)[1] for sylls in corpus]
+    if instrument.ENABLED:
+        instrument.count("segment.utterances", len(corpus))
+    return data.segs_to_mask(allsegs, corpus.offsets)
 
 
 ###
@@ -120,22 +288,62 @@ def build_lexicon_recursive(utts):
     return 
 
 
-def main():
-    train_utts = data.read_file("Brown_train_unseg.txt")
-    lexicon = build_lexicon(train_utts[:])
+def main(numshards=1, numworkers=None, seed=0, reconcile=False, drift=False, savefname=None, loadfname=None, strategy="greedy",
+         scored=False):
+    train_utts = data.load_corpus("Brown_train_unseg.txt")
+    if loadfname:
+        # segment-only run against a lexicon trained earlier
+        lexicon = load_lexicon(loadfname)
+    elif numshards > 1:
+        lexicon = build_lexicon_sharded(train_utts, numshards, numworkers, seed, reconcile, scored)
+    else:
+        lexicon = build_lexicon(train_utts, scored=scored)
+    if savefname:
+        save_lexicon(lexicon, savefname)
 
-    test_utts = data.read_file("Brown_test_unseg.txt")
-    goldsegs_train = data.get_goldsegs("Brown_train_gold.txt")
-    goldsegs_test = data.get_goldsegs("Brown_test_gold.txt")
+    test_utts = data.load_corpus("Brown_test_unseg.txt")
+    goldsegs_train = data.get_goldsegs(data.load_corpus("Brown_train_gold.txt"))
+    goldsegs_test = data.get_goldsegs(data.load_corpus("Brown_test_gold.txt"))
 
     for utts, goldsegs, title in ((train_utts, goldsegs_train, "Training"), (test_utts, goldsegs_test, "Testing")):
-        joineds, segs = get_segpoints(lexicon, utts)
-        stats = data.evaluate(goldsegs, segs)
+        with instrument.stage("segment"):
+            joineds, segs = get_segpoints_strategy(lexicon, utts, strategy)
+        with instrument.stage("evaluate"):
+            stats = data.evaluate(goldsegs, segs)
+        if instrument.ENABLED:
+            instrument.count("segment.utterances", len(utts))
+            instrument.count("evaluate.utterances", len(utts))
         print(title)
         print("P: %s\tR: %s\t\tF1: %s\n" % tuple([round(stat*100, 2) for stat in stats]))
 
+    if drift and numshards > 1 and not loadfname:
+        sequential = build_lexicon(train_utts, scored=scored)
+        stats = get_lexicon_drift(sequential, lexicon)
+        print("Drift from the sequential lexicon")
+        print("Shared words: %s\tJaccard: %s\tScore drift: %s" % (stats["shared"], round(stats["jaccard"], 4), round(stats["score_drift"], 4)))
+        goldmask = data.load_corpus("Brown_test_gold.txt").boundaries
+        f1s = [data.evaluate_masks(goldmask, get_segpoints_mask(lex, test_utts, strategy))[2] for lex in (sequential, lexicon)]
+        print("Test F1 sequential: %s\tsharded: %s\n" % tuple([round(f1*100, 2) for f1 in f1s]))
+
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--shards", type=int, default=1, help="build the lexicon on this many shards in parallel")
+    parser.add_argument("--workers", type=int, default=None, help="processes for --shards (default: all cores)")
+    parser.add_argument("--seed", type=int, default=0, help="seed for assigning utterances to shards")
+    parser.add_argument("--reconcile", action="store_true", help="run a second pass over the shards starting from the merged lexicon")
+    parser.add_argument("--drift", action="store_true", help="report how far the sharded lexicon and its F1 are from the sequential ones")
+    parser.add_argument("--save-lexicon", default=None, help="write the trained lexicon to this file")
+    parser.add_argument("--load-lexicon", default=None, help="segment with a lexicon file from --save-lexicon instead of training")
+    parser.add_argument("--scored", action="store_true",
+                        help="keep the lexicon scores in the trie while building it instead of using get_bestmatch and update_lexicon")
+    parser.add_argument("--strategy", choices=sorted(SEGMENTERS), default="greedy", help="how to segment utterances with the lexicon")
+    parser.add_argument("--profile", nargs="?", const=instrument.DEFAULT_REPORT, default=None,
+                        help="record counters and stage timings and write them to this JSON file (also set by %s)" % instrument.ENV_VAR)
+    args = parser.parse_args()
+    if args.profile:
+        instrument.enable(args.profile)
+    main(args.shards, args.workers, args.seed, args.reconcile, args.drift, args.save_lexicon, args.load_lexicon, args.strategy,
+         args.scored)
 
 
@@ -1,37 +1,219 @@
 import data
-import nltk
+import instrument
+import sys, argparse
+from collections import Counter, deque
+
+import numpy as np
 
 START = "START"
 STOP = "STOP"
 
 def pad(utt):
-    """Applies bigram padding with NLTK"""
-    return list(nltk.pad_sequence(utt,2,
-                                  pad_left=True,
-                                  pad_right=True,
-                                  left_pad_symbol=START,
-                                  right_pad_symbol=STOP))
+    """Applies bigram padding: one START before and one STOP after the utterance"""
+    return [START] + list(utt) + [STOP]
 
 
 def get_bigrams(tokenized):
     """Returns padded bigrams for a tokenized utterance"""
     padded = pad(tokenized)
-    return list(nltk.bigrams(padded))
+    return list(zip(padded, padded[1:]))
+
+
+class BigramModel(object):
+    """Bigram and context counts over integer syllable IDs, built one utterance at a time.
+    Each bigram is counted under a single packed int key: context ID << 32 | completion ID"""
+
+    def __init__(self):
+        self.syllables = [START, STOP] # syllable strings, indexed by ID
+        self.ids = {START: 0, STOP: 1} # syllable : ID
+        self.bigramcounts = Counter() # packed bigram key : frequency
+        self.contextcounts = Counter() # context ID : number of bigrams starting with it
+
+    @classmethod
+    def from_utterances(cls, utterances):
+        """Counts the bigrams of a list of utterance strings or a SyllableCorpus"""
+        model = cls()
+        if isinstance(utterances, data.SyllableCorpus):
+            # the corpus is already integer-encoded, so only its vocabulary needs mapping to model IDs
+            remap = [model.get_id(syll) for syll in utterances.vocab]
+            ids = utterances.ids.tolist()
+            offsets = utterances.offsets.tolist()
+            for start, stop in zip(offsets[:-1], offsets[1:]):
+                model.add_ids([remap[i] for i in ids[start:stop]])
+            return model
+        for tokenized in data.iter_tokenized(utterances):
+            model.add_utterance(tokenized)
+        return model
+
+    def get_id(self, syll):
+        """returns the ID of a syllable, assigning a new one if it hasn't been seen"""
+        if syll not in self.ids:
+            self.ids[syll] = len(self.syllables)
+            self.syllables.append(syll)
+        return self.ids[syll]
+
+    def add_utterance(self, tokenized):
+        """updates the counts with the padded bigrams of a tokenized utterance"""
+        self.add_ids([self.get_id(syll) for syll in tokenized])
+
+    def add_ids(self, ids):
+        """updates the counts with the padded bigrams of an utterance given as syllable IDs"""
+        ids = [0] + ids + [1]
+        self.bigramcounts.update([context << 32 | completion for context, completion in zip(ids, ids[1:])])
+        self.contextcounts.update(ids[:-1])
+
+    def tp(self, context, completion):
+        """returns the transitional probability P(completion | context), 0 if the bigram was never seen"""
+        contextid = self.ids.get(context)
+        completionid = self.ids.get(completion)
+        if contextid is None or completionid is None:
+            return 0.0
+        count = self.bigramcounts.get(contextid << 32 | completionid, 0)
+        return count / self.contextcounts[contextid] if count else 0.0
+
+    def to_probdict(self):
+        """returns the bigram probabilities as a dictionary {context:{completion:prob}}"""
+        probdict = {}
+        for key, count in self.bigramcounts.items():
+            contextid = key >> 32
+            completions = probdict.setdefault(self.syllables[contextid], {})
+            completions[self.syllables[key & 0xFFFFFFFF]] = count / self.contextcounts[contextid]
+        return probdict
+
+    def tp_table(self):
+        """returns (sorted array of packed bigram keys, array of their transitional probabilities) for vectorized lookup"""
+        keys = np.fromiter(self.bigramcounts.keys(), dtype=np.int64, count=len(self.bigramcounts))
+        counts = np.fromiter(self.bigramcounts.values(), dtype=float, count=len(self.bigramcounts))
+        contextcounts = np.zeros(len(self.syllables))
+        contextcounts[list(self.contextcounts.keys())] = list(self.contextcounts.values())
+        order = np.argsort(keys)
+        keys = keys[order]
+        return keys, counts[order] / contextcounts[keys >> 32]
+
+    def batch_tps(self, corpus):
+        """Looks up the transitional probability of every utterance-internal bigram of a SyllableCorpus in one gather.
+        Returns a float array parallel to corpus.ids where entry j is TP(syllable j -> syllable j+1), 0 for unseen
+        bigrams and NaN for the last syllable of each utterance"""
+        keys, probs = self.tp_table()
+        remap = np.array([self.ids.get(syll, -1) for syll in corpus.vocab] + [-1], dtype=np.int64)
+        ids = remap[np.asarray(corpus.ids)]
+        tps = np.full(len(ids), np.nan)
+        if len(ids) < 2 or len(keys) == 0:
+            tps[:-1] = 0.0
+        else:
+            contexts, completions = ids[:-1], ids[1:]
+            lookup = contexts << 32 | completions
+            found = np.minimum(np.searchsorted(keys, lookup), len(keys)-1)
+            hit = (keys[found] == lookup) & (contexts >= 0) & (completions >= 0)
+            tps[:-1] = np.where(hit, probs[found], 0.0)
+        tps[np.asarray(corpus.offsets[1:]) - 1] = np.nan
+        return tps
+
+
+class OnlineBigramModel(BigramModel):
+    """BigramModel that keeps its memory bounded while it is updated one utterance at a time.
+    With window, only the bigrams of the most recent window utterances are counted.
+    With maxbigrams, the least frequent half of the bigrams is dropped whenever more than
+    maxbigrams distinct bigrams are stored. Using both makes the window counts approximate"""
+
+    def __init__(self, window=None, maxbigrams=None):
+        BigramModel.__init__(self)
+        self.window = window # number of recent utterances to count, None for all of them
+        self.maxbigrams = maxbigrams # number of distinct bigrams that triggers pruning, None to never prune
+        self.history = deque() # IDs of the utterances currently in the window
 
+    def add_ids(self, ids):
+        """updates the counts with an utterance, then forgets the oldest one and prunes as needed"""
+        BigramModel.add_ids(self, ids)
+        if self.window:
+            self.history.append(ids)
+            if len(self.history) > self.window:
+                self.remove_ids(self.history.popleft())
+        if self.maxbigrams and len(self.bigramcounts) > self.maxbigrams:
+            self.prune(self.maxbigrams // 2)
 
-def flatten(utts):
-    """Flattens a list of lists of bigrams into a list of bigrams"""
-    return [bigram for utt in utts for bigram in utt]
+    def remove_ids(self, ids):
+        """takes the padded bigrams of an utterance back out of the counts"""
+        ids = [0] + ids + [1]
+        for context, completion in zip(ids, ids[1:]):
+            key = context << 32 | completion
+            # the bigram may already have been pruned
+            if key not in self.bigramcounts:
+                continue
+            self.bigramcounts[key] -= 1
+            self.contextcounts[context] -= 1
+            if not self.bigramcounts[key]:
+                del self.bigramcounts[key]
+            if not self.contextcounts[context]:
+                del self.contextcounts[context]
+
+    def prune(self, keep):
+        """drops all but the keep most frequent bigrams, keeping the context counts consistent"""
+        for key, count in self.bigramcounts.most_common()[keep:]:
+            del self.bigramcounts[key]
+            self.contextcounts[key >> 32] -= count
+            if not self.contextcounts[key >> 32]:
+                del self.contextcounts[key >> 32]
+
+
+def iter_stream_utterances(fin):
+    """Yields the syllabified utterance on each non-empty line of a stream.
+    Lines in the data file format (orthography, tab, syllables) are reduced to their syllables"""
+    for line in fin:
+        line = line.strip()
+        if line:
+            yield line.split("\t")[-1]
+
+
+def segment_stream(utts, model):
+    """Updates the model with each utterance as it arrives and segments it with the current statistics.
+    Yields each segmented utterance in the data.apply_boundaries format"""
+    for utt in utts:
+        tokenized = data.tokenize_syllables(utt)
+        model.add_utterance(tokenized)
+        tpseq = [model.tp(context, completion) for context, completion in zip(tokenized, tokenized[1:])]
+        yield data.apply_boundaries(tokenized, get_local_minima(tpseq))
+
+
+def get_batch_local_minima(tps, offsets):
+    """Finds the local minima of the TP sequences of a whole corpus at once with array shifts.
+    An index is a minimum if its TP is strictly lower than each neighbouring TP in the same utterance.
+    Indices at either end of an utterance only have one neighbour to compare with, and an utterance
+    with a single TP has no minima
+    input:
+        tps (array): TPs laid out as returned by BigramModel.batch_tps
+        offsets (array): utterance offsets, as in SyllableCorpus.offsets
+    return:
+        (array): uint8 boundary mask laid out like SyllableCorpus.boundaries
+    """
+    valid = ~np.isnan(tps)
+    left = np.full(len(tps), np.nan)
+    left[1:] = tps[:-1]
+    left[np.asarray(offsets[:-1])] = np.nan
+    right = np.full(len(tps), np.nan)
+    right[:-1] = tps[1:]
+    hasleft = ~np.isnan(left)
+    hasright = ~np.isnan(right)
+    with np.errstate(invalid="ignore"):
+        minima = valid & (hasleft | hasright) & (~hasleft | (tps < left)) & (~hasright | (tps < right))
+    return minima.astype(np.uint8)
+
+
+def get_batch_segpoints(corpus, model):
+    """Segments every utterance of a SyllableCorpus at the local minima of its TPs under a BigramModel.
+    Returns a boundary mask, which data.mask_to_segs turns into the same sets get_segpoints returns"""
+    return get_batch_local_minima(model.batch_tps(corpus), corpus.offsets)
 
 
 def get_bigramprobdict(utterances):
-    """Creates a bigram probability dictionary {context:{completion:prob}} using NLTK"""
-    bigrams = flatten([get_bigrams(data.tokenize_syllables(utt)) for utt in utterances])
-    freqdist = nltk.ConditionalFreqDist(bigrams)
-    probdist = nltk.ConditionalProbDist(freqdist, nltk.MLEProbDist)
-    probdict = {condition:{sample:probdist[condition].prob(sample)
-                           for sample in probdist[condition].samples()}
-                for condition in probdist.conditions()}
+    """Creates a bigram probability dictionary {context:{completion:prob}} from maximum likelihood estimates.
+    The utterances can be a list of strings or a SyllableCorpus"""
+    with instrument.stage("train"):
+        model = BigramModel.from_utterances(utterances)
+        probdict = model.to_probdict()
+    if instrument.ENABLED:
+        instrument.count("train.utterances", len(utterances))
+        instrument.count("train.bigram_types", len(model.bigramcounts))
     return probdict
     
 
@@ -74,26 +256,55 @@ def get_segpoints(tokenizeds, probdict):
 
 
 def main():
-    train_utts = data.read_file("Brown_train_unseg.txt")
+    train_utts = data.load_corpus("Brown_train_unseg.txt")
     probdict = get_bigramprobdict(train_utts)
 
-    test_utts = data.read_file("Brown_test_unseg.txt")
-    goldsegs_train = data.get_goldsegs("Brown_train_gold.txt")
-    goldsegs_test = data.get_goldsegs("Brown_test_gold.txt")
+    test_utts = data.load_corpus("Brown_test_unseg.txt")
+    goldsegs_train = data.get_goldsegs(data.load_corpus("Brown_train_gold.txt"))
+    goldsegs_test = data.get_goldsegs(data.load_corpus("Brown_test_gold.txt"))
 
     for utts, goldsegs, title in ((train_utts, goldsegs_train, "Training"), (test_utts, goldsegs_test, "Testing")):
-        sylls = [data.tokenize_syllables(utt) for utt in utts]
-        segs = get_segpoints(sylls, probdict)
+        sylls = list(utts)
+        with instrument.stage("segment"):
+            segs = get_segpoints(sylls, probdict)
+        if instrument.ENABLED:
+            instrument.count("segment.utterances", len(sylls))
 
         # Use data.apply_boundaries to helpvisualize the segmentations for debugging and answering
         # analysis questions
 
-        stats = data.evaluate(goldsegs, segs)
+        with instrument.stage("evaluate"):
+            stats = data.evaluate(goldsegs, segs)
         print(title)
         print("P: %s\tR: %s\t\tF1: %s\n" % tuple([round(stat*100, 2) for stat in stats]))
 
 
+def stream_main(fname, window, maxbigrams):
+    """Segments utterances from a file, or stdin if fname is -, printing each one as soon as it is processed"""
+    model = OnlineBigramModel(window, maxbigrams)
+    fin = sys.stdin if fname == "-" else open(fname, "r")
+    try:
+        for segmented in segment_stream(iter_stream_utterances(fin), model):
+            print(segmented, flush=True)
+    finally:
+        if fin is not sys.stdin:
+            fin.close()
+
+
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--stream", nargs="?", const="-", default=None,
+                        help="segment utterances online from this file (stdin if no file is given) instead of running the experiment")
+    parser.add_argument("--window", type=int, default=None, help="with --stream, only count the bigrams of the last WINDOW utterances")
+    parser.add_argument("--max-bigrams", type=int, default=None, help="with --stream, prune the rarest bigrams past this many")
+    parser.add_argument("--profile", nargs="?", const=instrument.DEFAULT_REPORT, default=None,
+                        help="record counters and stage timings and write them to this JSON file (also set by %s)" % instrument.ENV_VAR)
+    args = parser.parse_args()
+    if args.profile:
+        instrument.enable(args.profile)
+    if args.stream:
+        stream_main(args.stream, args.window, args.max_bigrams)
+    else:
+        main()
 
 
@@ -0,0 +1,95 @@
+import sys, time, tracemalloc
+
+import numpy as np
+from sklearn.metrics.cluster import v_measure_score
+
+import clustering
+
+
+def make_typedict(k_tree, k_context, seed=0):
+    """Builds a type dictionary of synthetic Words with Zipfian context counts"""
+    rng = np.random.default_rng(seed)
+    width = (k_context+3)*2
+    words = ["w%s" % i for i in range(k_tree)]
+    typedict = {}
+    for rank, word in enumerate(words):
+        typedict[word] = clustering.Word(word, k_context)
+        numtokens = max(10, int(20000 / (rank+1)))
+        contexts = np.minimum(rng.zipf(1.3, size=numtokens), width) - 1
+        for index in contexts:
+            typedict[word].contextvec[int(index)] += 1
+    return typedict, words
+
+
+def bench_distances(sizes, k_context=1000, distfuncname="dist_euclidean"):
+    """Times the pairwise thread path against the batched path for each k_tree in sizes.
+    The pairwise timings reflect whatever dist_* functions are currently implemented"""
+    distfunc = getattr(clustering, distfuncname)
+    print("k_tree\tpairwise (s)\tbatched (s)\tspeedup")
+    for k_tree in sizes:
+        typedict, words = make_typedict(k_tree, k_context)
+
+        start = time.perf_counter()
+        clustering.calc_distances_multi(typedict, distfunc, words)
+        pairwise = time.perf_counter() - start
+
+        start = time.perf_counter()
+        clustering.calc_distances_batched(typedict, distfuncname, words)
+        batched = time.perf_counter() - start
+
+        print("%s\t%.2f\t\t%.2f\t\t%.1fx" % (k_tree, pairwise, batched, pairwise/batched))
+
+
+def measure(func, *args):
+    """Runs func twice and returns its result, the wall time and the peak traced allocation in MB.
+    Tracing slows down Python code, so the time comes from a separate untraced run"""
+    start = time.perf_counter()
+    result = func(*args)
+    elapsed = time.perf_counter() - start
+    tracemalloc.start()
+    func(*args)
+    peak = tracemalloc.get_traced_memory()[1] / 2**20
+    tracemalloc.stop()
+    return result, elapsed, peak
+
+
+def exact_tree(typedict, distfuncname, words):
+    return clustering.make_tree(clustering.calc_distances_batched(typedict, distfuncname, words), "average")
+
+
+def approx_tree(typedict, distfuncname, words, numneighbours):
+    return clustering.make_tree_knn(*clustering.calc_knn_graph(typedict, distfuncname, words, numneighbours))
+
+
+def bench_approx(sizes, numneighbours=10, k_context=1000, distfuncname="dist_euclidean", cutofffrac=0.5):
+    """Compares time and peak memory of the exact and nearest neighbour trees for each k_tree in sizes.
+    Agreement is the V-measure between the two flat clusterings at cutofffrac"""
+    print("k_tree	exact (s)	exact (MB)	approx (s)	approx (MB)	agreement")
+    for k_tree in sizes:
+        typedict, words = make_typedict(k_tree, k_context)
+        exact, exacttime, exactmem = measure(exact_tree, typedict, distfuncname, words)
+        approx, approxtime, approxmem = measure(approx_tree, typedict, distfuncname, words, numneighbours)
+        labels = clustering.get_cluster_labels(exact, k_tree, [cutofffrac])[0]
+        approxlabels = clustering.get_cluster_labels(approx, k_tree, [cutofffrac])[0]
+        print("%s\t%.2f\t\t%.1f\t\t%.2f\t\t%.1f\t\t%.3f" % (k_tree, exacttime, exactmem, approxtime, approxmem,
+                                                         v_measure_score(labels, approxlabels)))
+
+
+def bench_ingest(categories="news", k_tree=1000, k_context=100):
+    """Compares time and peak memory of building the context vectors from Brown with read_corpus and friends
+    against the single streaming pass of ingest_corpus over the same categories. read_corpus reads the news
+    section, so the comparison is only like for like with the default categories. The lists path only does
+    real work once read_corpus, get_poscounts and update_contexts_sent are implemented"""
+    print("ingest	time (s)	peak (MB)	words")
+    for ingest in ("lists", "stream"):
+        (typedict, topkwords), elapsed, peak = measure(clustering.build_contexts, True, k_tree, k_context, ingest, categories)
+        print("%s\t%.2f\t\t%.1f\t\t%s" % (ingest, elapsed, peak, len(topkwords)))
+
+
+if __name__=="__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "approx":
+        bench_approx([int(k) for k in sys.argv[2:]] or [2000, 5000, 10000])
+    elif len(sys.argv) > 1 and sys.argv[1] == "ingest":
+        bench_ingest(sys.argv[2].split(",") if len(sys.argv) > 2 else "news")
+    else:
+        bench_distances([int(k) for k in sys.argv[1:]] or [500, 2000, 5000])
@@ -0,0 +1,74 @@
+import os, json, hashlib, shutil, tempfile
+
+import numpy as np
+
+META = "meta.json"
+
+
+class ArrayCache(object):
+    """On-disk cache of named NumPy arrays plus JSON metadata.
+    Each entry is a directory named by the hash of the parameters that produced it.
+    Arrays are memory-mapped on load, and the least recently used entries are evicted
+    once the cache grows past maxbytes"""
+
+    def __init__(self, cachedir, maxbytes):
+        self.cachedir = cachedir # directory holding one subdirectory per entry
+        self.maxbytes = maxbytes # size cap for all entries together
+        os.makedirs(cachedir, exist_ok=True)
+
+    def key(self, **params):
+        """returns the content address for an entry computed from params"""
+        return hashlib.sha1(json.dumps(params, sort_keys=True).encode("utf-8")).hexdigest()
+
+    def load(self, key):
+        """returns (dict of name : read-only memory-mapped array, metadata) for key, or None on a miss"""
+        entrydir = os.path.join(self.cachedir, key)
+        try:
+            with open(os.path.join(entrydir, META), "r") as fin:
+                meta = json.load(fin)
+            arrays = {name: np.load(os.path.join(entrydir, name + ".npy"), mmap_mode="r") for name in meta["arrays"]}
+        except (OSError, ValueError, KeyError):
+            return None
+        # the directory mtime doubles as the last access time for LRU eviction
+        os.utime(entrydir)
+        return arrays, meta["meta"]
+
+    def store(self, key, arrays, meta):
+        """writes arrays (dict of name : array) and JSON-serializable meta under key, then evicts old entries"""
+        entrydir = os.path.join(self.cachedir, key)
+        tmpdir = tempfile.mkdtemp(dir=self.cachedir, prefix=".tmp")
+        try:
+            for name, array in arrays.items():
+                np.save(os.path.join(tmpdir, name + ".npy"), array)
+            with open(os.path.join(tmpdir, META), "w") as fout:
+                json.dump({"arrays": sorted(arrays), "meta": meta}, fout)
+            if os.path.isdir(entrydir):
+                shutil.rmtree(entrydir)
+            os.rename(tmpdir, entrydir)
+        except BaseException:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+            raise
+        self.evict(keep=key)
+
+    def entries(self):
+        """returns (mtime, size in bytes, path) for every entry"""
+        entries = []
+        for name in os.listdir(self.cachedir):
+            entrydir = os.path.join(self.cachedir, name)
+            if name.startswith(".") or not os.path.isdir(entrydir):
+                continue
+            size = sum(os.path.getsize(os.path.join(entrydir, fname)) for fname in os.listdir(entrydir))
+            entries.append((os.path.getmtime(entrydir), size, entrydir))
+        return entries
+
+    def evict(self, keep=None):
+        """removes the least recently used entries until the cache fits in maxbytes. Never removes keep"""
+        entries = sorted(self.entries())
+        total = sum(size for mtime, size, entrydir in entries)
+        for mtime, size, entrydir in entries:
+            if total <= self.maxbytes:
+                break
+            if os.path.basename(entrydir) == keep:
+                continue
+            shutil.rmtree(entrydir, ignore_errors=True)
+            total -= size
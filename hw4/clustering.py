@@ -1,20 +1,27 @@
-import re, math, sys
+import re, os, argparse, tempfile, json, hashlib, heapq, inspect
+from collections import Counter
 from threading import Thread
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
 
 # User installed
 import nltk.corpus
 import numpy as np
+import scipy.sparse as sparse
 import scipy.spatial.distance as dist
 import scipy.cluster.hierarchy as hierarchy
-from matplotlib import pyplot as plt
 from sklearn.metrics.cluster import homogeneity_score, completeness_score, v_measure_score
 
+from cache import ArrayCache
+
 START = "<START>"
 STOP = "<STOP>"
 LEFT = "<LEFT>"
 RIGHT = "<RIGHT>"
 UNKNOWN = "<UNK>"
 
+word_rx = re.compile(r"\w+$")
+
 
 
 class Word(object):
@@ -24,13 +31,21 @@ class Word(object):
         self.wordform = wordform # string representing the word
         self.posfreqs = {} # dictionary of POS tag : frquency
         self.maxpos = None # most frequent POS tag
-        self.contextvec = [0] * (contextlen+3)*2 # vector for context word counts
+        self.contextlen = (contextlen+3)*2 # length of the full context vector
+        self.contextvec = Counter() # sparse vector for context word counts. Maps index : count, missing indices are 0
 
     def updatepos(self, tokenpos):
         """updates token frequency of each POS tag for this Word and updates the most frequent tag"""
         self.posfreqs[tokenpos] = self.posfreqs.get(tokenpos,0) + 1
         if not self.maxpos or self.posfreqs[tokenpos] > self.posfreqs[self.maxpos]:
             self.maxpos = tokenpos
+
+    def densevec(self):
+        """returns the context vector as a dense list of counts"""
+        vec = [0] * self.contextlen
+        for index, count in self.contextvec.items():
+            vec[index] = count
+        return vec
     
     def __repr__(self):
         return self.wordform
@@ -65,9 +80,13 @@ def get_topkwordlist(notags, k, padding):
         for word in sent:
             if padding:
                 freqdict[word] = freqdict.get(word,0) + 1
-            elif re.match(r"\w+$", word):
+            elif word_rx.match(word):
                 freqdict[word] = freqdict.get(word,0) + 1
+    return get_topkfromfreqs(freqdict, k, padding)
+
 
+def get_topkfromfreqs(freqdict, k, padding):
+    """Returns the k most frequent words in a dictionary of word : frequency, plus START, STOP and UNKNOWN if padding"""
     sortedwordfreqs = sorted(freqdict.items(), key = lambda kv: kv[1], reverse=True)
     topk = [w for w, freq in sortedwordfreqs][0:k]
     if padding:
@@ -75,6 +94,45 @@ def get_topkwordlist(notags, k, padding):
     return topk
 
 
+def iter_tagged_sents(use_universal, categories):
+    """Lazily yields the Brown sentences in categories (None for the whole corpus) as lists of (lowercased word, tag) pairs"""
+    tagset = "universal" if use_universal else None
+    for sent in nltk.corpus.brown.tagged_sents(categories=categories, tagset=tagset):
+        yield [(word.lower(), tag) for word, tag in sent]
+
+
+def iter_token_file(fin):
+    """Yields the sentences written to a token file by ingest_corpus as lists of words"""
+    fin.seek(0)
+    for line in fin:
+        yield line.rstrip("\n").split("\t")
+
+
+def ingest_corpus(use_universal, k_tree, k_context, categories="news"):
+    """Streams Brown once to build the type dictionary with POS and context counts and the k_tree words to cluster.
+    The first pass over the tagged sentences counts POS tags and word frequencies and caches the lowercased tokens
+    in a temporary file. Once the context words are known, the second pass fills the context vectors from that file"""
+    typedict = {}
+    padfreqs = {}
+    wordfreqs = {}
+    with tempfile.TemporaryFile("w+", encoding="utf-8") as tokenfile:
+        for sent in iter_tagged_sents(use_universal, categories):
+            for word, tag in sent:
+                if word not in typedict:
+                    typedict[word] = Word(word, k_context)
+                typedict[word].updatepos(tag)
+                padfreqs[word] = padfreqs.get(word,0) + 1
+                if word_rx.match(word):
+                    wordfreqs[word] = wordfreqs.get(word,0) + 1
+            tokenfile.write("\t".join(word for word, tag in sent) + "\n")
+
+        indexdict = get_indexdict(get_topkfromfreqs(padfreqs, k_context, padding=True))
+        topkwords = get_topkfromfreqs(wordfreqs, k_tree, padding=False)
+        del padfreqs, wordfreqs
+        update_contexts(iter_token_file(tokenfile), typedict, indexdict)
+    return typedict, topkwords
+
+
 def get_indexdict(words):
     """Associates each word type with an index in the context vector"""
     indexdict = {}
@@ -129,10 +187,108 @@ def get_clusters(tree, wordlist, cutofffrac):
     return filtered_clusters
 
 
-def calc_distances_multi(typedict, distfunc, words_topk):
+def make_tree_knn(neighbours, neighbourdists, maxlinks=None):
+    """Approximates average-linkage clustering using only the edges of a nearest neighbour graph.
+    The distance between two clusters is the mean of the known distances between their members, and clusters
+    with no known edges between them are only joined at the very end. Each new cluster keeps at most maxlinks
+    of its closest neighbouring clusters (default 4 times the neighbours per word) so joins stay cheap.
+    Join distances are kept non-decreasing so the result is a linkage matrix that get_clusters,
+    get_cluster_labels and plot_dendrogram accept"""
+    numleaves = len(neighbours)
+    maxlinks = maxlinks or 4*max(1, neighbours.shape[1])
+    links = [{} for i in range(numleaves)] # cluster id : {neighbouring cluster id : [sum of distances, number of distances]}
+    sizes = [1] * numleaves
+    heap = []
+    for i in range(numleaves):
+        for j, distance in zip(neighbours[i].tolist(), neighbourdists[i].tolist()):
+            if i != j and j not in links[i]:
+                links[i][j] = [distance, 1]
+                links[j][i] = [distance, 1]
+                heap.append((distance, min(i, j), max(i, j)))
+    heapq.heapify(heap)
+
+    rows = []
+    height = 0.0
+    while heap:
+        distance, left, right = heapq.heappop(heap)
+        # entries for clusters that were already joined into something else are stale
+        if links[left] is None or links[right] is None:
+            continue
+        node = numleaves + len(rows)
+        height = max(height, distance)
+        rows.append((left, right, height, sizes[left] + sizes[right]))
+        sizes.append(sizes[left] + sizes[right])
+        merged = {}
+        for child in (left, right):
+            for other, (total, count) in links[child].items():
+                if other in (left, right):
+                    continue
+                del links[other][child]
+                summed = merged.setdefault(other, [0.0, 0])
+                summed[0] += total
+                summed[1] += count
+            links[child] = None
+        if len(merged) > maxlinks:
+            merged = dict(heapq.nsmallest(maxlinks, merged.items(), key=lambda kv: kv[1][0]/kv[1][1]))
+        for other, summed in merged.items():
+            links[other][node] = summed
+            heapq.heappush(heap, (summed[0]/summed[1], other, node))
+        links.append(merged)
+
+    # joins whatever disconnected components are left at the largest distance seen
+    remaining = [i for i, linked in enumerate(links) if linked is not None]
+    while len(remaining) > 1:
+        left, right = remaining.pop(0), remaining.pop(0)
+        rows.append((left, right, height, sizes[left] + sizes[right]))
+        sizes.append(sizes[left] + sizes[right])
+        remaining.append(numleaves + len(rows) - 1)
+    return np.array(rows, dtype=float).reshape(-1, 4)
+
+
+def get_cluster_labels(tree, numleaves, cutofffracs):
+    """Assigns every leaf to a flat cluster for each cutoff fraction without building member sets.
+    Uses the same clusters as filter_clusters: the largest subtrees whose joins are all closer than
+    max distance * cutofffrac, labelled with the same ids as get_clusters. Assumes join distances never
+    decrease up the tree, which holds for average linkage.
+    Returns an array with one row of leaf labels per cutoff fraction"""
+    leftids = tree[:,0].astype(np.int64)
+    rightids = tree[:,1].astype(np.int64)
+    nodeids = numleaves + np.arange(len(tree))
+    maxdistance = tree[:,2].max() if len(tree) else 0
+    labels = np.empty((len(cutofffracs), numleaves), dtype=np.int64)
+    for row, cutofffrac in enumerate(cutofffracs):
+        joined = tree[:,2] < maxdistance*cutofffrac
+        parents = np.arange(numleaves + len(tree))
+        parents[leftids[joined]] = nodeids[joined]
+        parents[rightids[joined]] = nodeids[joined]
+        # pointer jumping: after each step every node points twice as far up the tree
+        while True:
+            grandparents = parents[parents]
+            if np.array_equal(grandparents, parents):
+                break
+            parents = grandparents
+        labels[row] = parents[:numleaves]
+    return labels
+
+
+def evaluate_labels(labels, wordlist, typedict):
+    """Calculates homogeneity, completeness, and V-measure like evaluate for an array of flat cluster labels, one per word"""
+    golds = [typedict[word].maxpos for word in wordlist]
+    return homogeneity_score(golds, labels), completeness_score(golds, labels), v_measure_score(golds, labels, beta=2.0)
+
+
+def sweep_cutoffs(tree, wordlist, typedict, cutofffracs):
+    """Evaluates the flat clusterings of one tree at every cutoff fraction.
+    Returns a list of (cutofffrac, homogeneity, completeness, V-measure)"""
+    labels = get_cluster_labels(tree, len(wordlist), cutofffracs)
+    return [(cutofffrac,) + evaluate_labels(row, wordlist, typedict) for cutofffrac, row in zip(cutofffracs, labels)]
+
+
+def calc_distances_multi(typedict, distfunc, words_topk, numsplits=8):
     """calculates the distance between two subtrees"""
     distances = np.zeros((len(words_topk),len(words_topk)))
-    numsplits = 8 # Set numsplits to a number that works for you. Something between 4-16 for speed. 1 for debugging.
+    densevecs = {word: typedict[word].densevec() for word in words_topk}
+    # Set numsplits to a number that works for you. Something between 4-16 for speed. 1 for debugging.
 
     def worker(lmin, lmax, rmin, rmax):
         for i, word1 in enumerate(words_topk):
@@ -147,7 +303,7 @@ def calc_distances_multi(typedict, distfunc, words_topk):
                     break
                 if j > i:
                     break
-                distances[i,j] = distfunc(typedict[word1].contextvec, typedict[word2].contextvec)
+                distances[i,j] = distfunc(densevecs[word1], densevecs[word2])
                 distances[j,i] = distances[i,j]
 
     q, r = divmod(len(words_topk), numsplits)
@@ -170,13 +326,283 @@ def calc_distances_multi(typedict, distfunc, words_topk):
     return distances
 
 
-def plot_dendrogram(tree, title, outname, namelist, k, frac):
-    """Plots the agglomerative clusterings and saves to file"""
+def get_context_matrix(typedict, words, dtype=float):
+    """Stacks the sparse context vectors of the words into a CSR matrix with one row per word"""
+    width = typedict[words[0]].contextlen if words else 0
+    indptr = [0]
+    indices = []
+    counts = []
+    for word in words:
+        contextvec = typedict[word].contextvec
+        indices.extend(contextvec.keys())
+        counts.extend(contextvec.values())
+        indptr.append(len(indices))
+    matrix = sparse.csr_matrix((np.array(counts, dtype=dtype), np.array(indices, dtype=np.int32), np.array(indptr)),
+                               shape=(len(words), width))
+    matrix.sort_indices()
+    return matrix
+
+
+def norm_rows(matrix):
+    """Divides each row of the sparse matrix by its sum. Rows that sum to 0 are left as zeros"""
+    sums = np.asarray(matrix.sum(axis=1)).ravel()
+    scales = np.divide(1.0, sums, out=np.zeros_like(sums, dtype=float), where=sums > 0)
+    return sparse.csr_matrix(sparse.diags(scales) @ matrix)
+
+
+def row_sums(matrix):
+    """Sums each row of a sparse matrix into a flat array"""
+    return np.asarray(matrix.sum(axis=1)).ravel()
+
+
+def block_euclidean(normed, start, stop):
+    """Euclidean distances between rows start:stop and every row of the normalized matrix"""
+    sqnorms = row_sums(normed.multiply(normed))
+    block = sqnorms[start:stop,None] + sqnorms[None,:] - 2*(normed[start:stop] @ normed.T).toarray()
+    return np.sqrt(np.maximum(block, 0))
+
+
+def block_manhattan(normed, start, stop):
+    """Manhattan distances between rows start:stop and every row of the normalized matrix.
+    Uses |w-v| = |w| + |v| - 2*sum(min(w,v)), where the sum only runs over shared nonzero columns"""
+    bycolumn = normed.tocsc()
+    l1s = row_sums(normed)
+    block = np.zeros((stop-start, normed.shape[0]))
+    for i in range(start, stop):
+        row = normed[i]
+        shared = bycolumn[:,row.indices]
+        shared.data = np.minimum(shared.data, np.repeat(row.data, np.diff(shared.indptr)))
+        block[i-start] = l1s[i] + l1s - 2*row_sums(shared)
+    return np.maximum(block, 0)
+
+
+def block_cossim(normed, start, stop):
+    """-(cosine similarity - 1) between rows start:stop and every row, rounded to 5 decimal places"""
+    lengths = np.sqrt(row_sums(normed.multiply(normed)))
+    dots = (normed[start:stop] @ normed.T).toarray()
+    outer = lengths[start:stop,None] * lengths[None,:]
+    cossims = np.divide(dots, outer, out=np.zeros_like(dots), where=outer > 0)
+    return np.round(1 - cossims, 5)
+
+
+# maps the names of the pairwise distance functions to their batched equivalents. dist_kl has none,
+# since how it handles contexts only one of the vectors has is left to its implementation
+BATCHED_DISTANCES = {
+    "dist_euclidean": block_euclidean,
+    "dist_manhattan": block_manhattan,
+    "dist_cossim": block_cossim,
+}
+
+
+def calc_distances_batched(typedict, distfuncname, words_topk, blocksize=2**22):
+    """Calculates the condensed distance matrix for words_topk with whole-matrix operations.
+    The rows are processed in blocks of roughly blocksize distances to keep memory bounded.
+    The result can be passed straight to make_tree"""
+    if distfuncname not in BATCHED_DISTANCES:
+        raise ValueError("%s has no batched version, choose from %s" % (distfuncname, ", ".join(sorted(BATCHED_DISTANCES))))
+    blockfunc = BATCHED_DISTANCES[distfuncname]
+    normed = norm_rows(get_context_matrix(typedict, words_topk))
+    normed.eliminate_zeros()
+    n = len(words_topk)
+    distances = np.zeros(n*(n-1)//2)
+    rowsperblock = max(1, blocksize // max(n, 1))
+    pos = 0
+    for start in range(0, n, rowsperblock):
+        stop = min(start+rowsperblock, n)
+        block = blockfunc(normed, start, stop)
+        for i in range(start, stop):
+            distances[pos:pos+n-i-1] = block[i-start, i+1:]
+            pos += n-i-1
+    return distances
+
+
+def calc_knn_graph(typedict, distfuncname, words_topk, numneighbours, blocksize=2**20):
+    """Finds the numneighbours closest other words for every word with the batched metrics, one block of rows
+    at a time, so memory grows with n * numneighbours instead of n * n.
+    Returns (neighbours, distances) arrays with one row per word"""
+    if distfuncname not in BATCHED_DISTANCES:
+        raise ValueError("%s has no batched version, choose from %s" % (distfuncname, ", ".join(sorted(BATCHED_DISTANCES))))
+    blockfunc = BATCHED_DISTANCES[distfuncname]
+    normed = norm_rows(get_context_matrix(typedict, words_topk))
+    normed.eliminate_zeros()
+    n = len(words_topk)
+    numneighbours = max(0, min(numneighbours, n-1))
+    neighbours = np.zeros((n, numneighbours), dtype=np.int64)
+    neighbourdists = np.zeros((n, numneighbours))
+    rowsperblock = max(1, blocksize // max(n, 1))
+    for start in range(0, n, rowsperblock):
+        stop = min(start+rowsperblock, n)
+        block = blockfunc(normed, start, stop)
+        block[np.arange(stop-start), np.arange(start, stop)] = np.inf
+        closest = np.argpartition(block, numneighbours-1, axis=1)[:,:numneighbours] if numneighbours else neighbours[start:stop]
+        neighbours[start:stop] = closest
+        neighbourdists[start:stop] = np.take_along_axis(block, closest, axis=1)
+    return neighbours, neighbourdists
+
+
+def get_tiles(n, numtiles):
+    """Splits the rows of the upper triangle of an n x n matrix into at most numtiles
+    contiguous (start, stop) row ranges holding roughly the same number of pairs"""
+    pairsbefore = np.cumsum(np.arange(n-1, -1, -1)) - np.arange(n-1, -1, -1)
+    targets = np.linspace(0, n*(n-1)//2, numtiles+1)[1:-1]
+    bounds = np.unique(np.concatenate(([0], np.searchsorted(pairsbefore, targets), [n])))
+    return [(int(start), int(stop)) for start, stop in zip(bounds[:-1], bounds[1:])]
+
+
+# shared memory views set up in each worker process by init_pool_worker
+POOL_STATE = {}
+
+
+def init_pool_worker(shmnames, specs, width, distfunc):
+    """Attaches a worker process to the shared CSR context matrix and condensed distance buffer"""
+    POOL_STATE["shms"] = [shared_memory.SharedMemory(name=name) for name in shmnames]
+    data, indices, indptr, distances = [np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+                                        for shm, (shape, dtype) in zip(POOL_STATE["shms"], specs)]
+    POOL_STATE["matrix"] = (data, indices, indptr)
+    POOL_STATE["distances"] = distances
+    POOL_STATE["width"] = width
+    POOL_STATE["distfunc"] = distfunc
+
+
+def densify_row(matrix, i, width):
+    """Expands row i of a (data, indices, indptr) CSR triple into a dense list of counts"""
+    data, indices, indptr = matrix
+    vec = [0] * width
+    for index, count in zip(indices[indptr[i]:indptr[i+1]].tolist(), data[indptr[i]:indptr[i+1]].tolist()):
+        vec[index] = count
+    return vec
+
+
+def pool_worker(tile):
+    """Fills in the condensed distances for every pair whose first row is in the tile"""
+    start, stop = tile
+    matrix = POOL_STATE["matrix"]
+    distances = POOL_STATE["distances"]
+    width = POOL_STATE["width"]
+    distfunc = POOL_STATE["distfunc"]
+    n = len(matrix[2]) - 1
+    pos = n*start - start*(start+1)//2
+    for i in range(start, stop):
+        vec1 = densify_row(matrix, i, width)
+        for j in range(i+1, n):
+            distances[pos] = distfunc(vec1, densify_row(matrix, j, width))
+            pos += 1
+    return stop - start
+
+
+def calc_distances_pool(typedict, distfunc, words_topk, numworkers):
+    """Calculates the condensed distance matrix for words_topk by calling distfunc in a pool of processes.
+    The sparse context matrix and the results live in shared memory, so only row ranges are sent to the workers"""
+    matrix = get_context_matrix(typedict, words_topk, dtype=np.int64)
+    n = len(words_topk)
+    arrays = [matrix.data, matrix.indices, matrix.indptr, np.zeros(n*(n-1)//2)]
+    shms = [shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1)) for array in arrays]
+    try:
+        for shm, array in zip(shms, arrays):
+            np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[:] = array
+        specs = [(array.shape, array.dtype) for array in arrays]
+        initargs = ([shm.name for shm in shms], specs, matrix.shape[1], distfunc)
+        # several tiles per worker so that a slow tile doesn't leave the other workers idle
+        tiles = get_tiles(n, numworkers*4)
+        with ProcessPoolExecutor(numworkers, initializer=init_pool_worker, initargs=initargs) as pool:
+            list(pool.map(pool_worker, tiles))
+        distances = np.ndarray((n*(n-1)//2,), dtype=float, buffer=shms[-1].buf).copy()
+    finally:
+        for shm in shms:
+            shm.close()
+            shm.unlink()
+    return distances
+
+
+def build_contexts(use_universal, k_tree, k_context, ingest, categories):
+    """Reads the corpus and populates the context vectors. Returns the type dictionary and the words to cluster"""
+    if ingest == "stream":
+        return ingest_corpus(use_universal, k_tree, k_context, categories)
+
+    # reads the corpus
+    golds, notags = read_corpus(use_universal)
+    # populations the type dictionary
+    typedict = get_poscounts(golds, k_context)
+    # gets the top k most frequent words as context words
+    contextwords = get_topkwordlist(notags, k_context, padding=True)
+    # makes an index dictionary to for looking up with the context vectors
+    indexdict = get_indexdict(contextwords)
+    # gets the top k words taht will actually be clustered
+    topkwords = get_topkwordlist(notags, k_tree, padding=False)
+    update_contexts(notags, typedict, indexdict)
+    return typedict, topkwords
+
+
+def calc_distances(typedict, distfuncname, words_topk, backend, numworkers):
+    """Calculates the condensed distance matrix with the requested backend.
+    numworkers is the number of processes for the pool backend (default: all cores) and
+    numsplits for the thread backend (default: that of calc_distances_multi)"""
+    if backend == "auto":
+        backend = "batched" if distfuncname in BATCHED_DISTANCES else "pool"
+    if backend == "batched":
+        return calc_distances_batched(typedict, distfuncname, words_topk)
+    distfunc = globals()[distfuncname]
+    if backend == "pool":
+        return calc_distances_pool(typedict, distfunc, words_topk, numworkers or os.cpu_count())
+    # the thread backend starts numsplits*(numsplits+1)/2 threads, so it keeps its own small default
+    if numworkers:
+        return dist.squareform(calc_distances_multi(typedict, distfunc, words_topk, numworkers))
+    return dist.squareform(calc_distances_multi(typedict, distfunc, words_topk))
+
+
+def get_corpus_fingerprint(categories):
+    """Hashes the location, names and sizes of the Brown files in categories so cached results go stale with the corpus"""
+    brown = nltk.corpus.brown
+    stats = [(fileid, brown.abspath(fileid).file_size()) for fileid in brown.fileids(categories=categories)]
+    return hashlib.sha1(json.dumps([str(brown.root), stats]).encode("utf-8")).hexdigest()
+
+
+def get_source_fingerprint(objs):
+    """Hashes the source code of functions and classes so cached results go stale when any of them is edited"""
+    return hashlib.sha1("\n".join(inspect.getsource(obj) for obj in objs).encode("utf-8")).hexdigest()
+
+
+def typedict_to_arrays(typedict, words):
+    """Packs the context vectors and POS counts of words into arrays and JSON metadata for the cache"""
+    matrix = get_context_matrix(typedict, words, dtype=np.int64)
+    arrays = {"data": matrix.data, "indices": matrix.indices, "indptr": matrix.indptr}
+    meta = {"words": words,
+            "posfreqs": [typedict[word].posfreqs for word in words],
+            "maxpos": [typedict[word].maxpos for word in words]}
+    return arrays, meta
+
+
+def typedict_from_arrays(arrays, meta, k_context):
+    """Rebuilds the type dictionary and word list packed by typedict_to_arrays"""
+    data, indices, indptr = arrays["data"], arrays["indices"], arrays["indptr"]
+    typedict = {}
+    for i, word in enumerate(meta["words"]):
+        typedict[word] = Word(word, k_context)
+        typedict[word].posfreqs = meta["posfreqs"][i]
+        typedict[word].maxpos = meta["maxpos"][i]
+        typedict[word].contextvec = Counter(dict(zip(indices[indptr[i]:indptr[i+1]].tolist(), data[indptr[i]:indptr[i+1]].tolist())))
+    return typedict, list(meta["words"])
+
+
+def plot_dendrogram(tree, title, outname, namelist, k, frac, show=True, topn=None):
+    """Plots the agglomerative clusterings and saves to file.
+    With show=False the figure is rendered with the non-interactive Agg backend and never displayed.
+    With topn, only the last topn joins are drawn and each truncated subtree is labelled with its size"""
+    # matplotlib is only imported when a picture is actually requested
+    import matplotlib
+    if not show:
+        matplotlib.use("Agg")
+    from matplotlib import pyplot as plt
+
     def label_func(leafnum):
+        if leafnum >= len(namelist):
+            return "(%d)" % tree[leafnum-len(namelist), 3]
         word = namelist[leafnum]
         return word
 
-    plt.figure(figsize=(int(0.45*k), int(0.4*k)))
+    if topn:
+        k = min(k, topn)
+    plt.figure(figsize=(max(1, int(0.45*k)), max(1, int(0.4*k))))
     plt.title(title)
     plt.xlabel('sample index')
     plt.ylabel('distance')
@@ -187,9 +613,42 @@ def plot_dendrogram(tree, title, outname, namelist, k, frac):
         leaf_label_func = label_func,
         color_threshold = frac*max(tree[:,2]),
         distance_sort='descending',
+        truncate_mode = 'lastp' if topn else None,
+        p = topn or 30,
     )
     plt.savefig(outname)
-    plt.show()
+    if show:
+        plt.show()
+    plt.close()
+
+
+def newick_label(word):
+    """Quotes a word for use as a Newick leaf label if it contains reserved characters"""
+    if re.search(r"[\s()\[\]':;,]", word):
+        return "'%s'" % word.replace("'", "''")
+    return word
+
+
+def write_tree(tree, namelist, outname):
+    """Writes the linkage tree without drawing it. Files ending in .json get the labels and the raw linkage
+    rows, anything else gets a Newick string with branch lengths taken from the join distances"""
+    if outname.endswith(".json"):
+        with open(outname, "w") as fout:
+            json.dump({"labels": list(namelist), "linkage": tree.tolist()}, fout)
+        return
+
+    # built bottom-up so deep trees don't hit the recursion limit
+    numleaves = len(namelist)
+    subtrees = {i: newick_label(word) for i, word in enumerate(namelist)}
+    heights = [0.0] * numleaves + tree[:,2].tolist()
+    for i, row in enumerate(tree):
+        node = numleaves + i
+        children = []
+        for child in (int(row[0]), int(row[1])):
+            children.append("%s:%s" % (subtrees.pop(child), heights[node] - heights[child]))
+        subtrees[node] = "(%s)" % ",".join(children)
+    with open(outname, "w") as fout:
+        fout.write("".join(subtrees.values()) + ";\n")
 
 
 
@@ -320,39 +779,105 @@ def evaluate(clusters, typedict):
     return homogeneity_score(golds, preds), completeness_score(golds, preds), v_measure_score(golds, preds, beta=2.0)
 
 
-def main(use_universal, k_tree, k_context, cutoff_frac, distfuncname, treefname):
-    # finds the distance function specified by the command line argument
-    distfunc = globals()[distfuncname]
-
-    # reads the corpus
-    golds, notags = read_corpus(use_universal)
-    # populations the type dictionary
-    typedict = get_poscounts(golds, k_context)
-    # gets the top k most frequent words as context words
-    contextwords = get_topkwordlist(notags, k_context, padding=True)
-    # makes an index dictionary to for looking up with the context vectors
-    indexdict = get_indexdict(contextwords)
-    # gets the top k words taht will actually be clustered
-    topkwords = get_topkwordlist(notags, k_tree, padding=False)
-
-    print("Populating context vectors", k_context)
-    update_contexts(notags, typedict, indexdict)
-
-    print("Calculating distances. Be Patient...")
-    distances = calc_distances_multi(typedict, distfunc, topkwords)
+def main(use_universal, k_tree, k_context, cutoff_frac, distfuncname, treefname, numworkers=None, backend="auto",
+         ingest="lists", categories="news", cachedir=None, cachebytes=2**30, sweepfracs=None,
+         render="show", topn=None, treeoutname=None, numneighbours=None):
+    # the cache is skipped entirely when cachedir is None
+    cache = ArrayCache(cachedir, cachebytes) if cachedir else None
+    if cache:
+        # the keys include the code that produces each entry, so fixing any of it invalidates the cache
+        contextcode = get_source_fingerprint([Word, build_contexts, ingest_corpus, iter_tagged_sents, iter_token_file,
+                                              read_corpus, get_poscounts, get_topkwordlist, get_topkfromfreqs,
+                                              get_indexdict, update_contexts, update_contexts_sent])
+        contextkey = cache.key(use_universal=use_universal, k_tree=k_tree, k_context=k_context, ingest=ingest,
+                               categories=categories, corpus=get_corpus_fingerprint(categories), code=contextcode)
+        distcode = get_source_fingerprint([calc_distances, calc_distances_batched, calc_distances_pool, calc_distances_multi,
+                                           calc_knn_graph, norm_rows, norm, globals()[distfuncname]]
+                                          + list(BATCHED_DISTANCES.values()))
+        distkey = cache.key(contexts=contextkey, distfuncname=distfuncname, numneighbours=numneighbours,
+                            backend=backend, code=distcode)
+
+    cached = cache.load(contextkey) if cache else None
+    if cached:
+        print("Loading cached context vectors", k_context)
+        typedict, topkwords = typedict_from_arrays(*cached, k_context)
+    else:
+        print("Populating context vectors", k_context)
+        typedict, topkwords = build_contexts(use_universal, k_tree, k_context, ingest, categories)
+        if cache:
+            cache.store(contextkey, *typedict_to_arrays(typedict, topkwords))
+
+    cached = cache.load(distkey) if cache else None
+    if cached:
+        print("Loading cached distances")
+        distances = cached[0]
+    elif numneighbours:
+        print("Finding the %s nearest neighbours of each word" % numneighbours)
+        neighbours, neighbourdists = calc_knn_graph(typedict, distfuncname, topkwords, numneighbours)
+        distances = {"neighbours": neighbours, "neighbourdists": neighbourdists}
+    else:
+        print("Calculating distances. Be Patient...")
+        distances = {"distances": calc_distances(typedict, distfuncname, topkwords, backend, numworkers)}
+    if cache and not cached:
+        cache.store(distkey, distances, {})
 
     print("Getting clusters")
-    tree = make_tree(dist.squareform(distances), 'average')
+    if numneighbours:
+        tree = make_tree_knn(distances["neighbours"], distances["neighbourdists"])
+    else:
+        tree = make_tree(distances["distances"], 'average')
     clusters = get_clusters(tree, topkwords, cutoff_frac)
     h, c, v = evaluate(clusters, typedict)
     print("H: %s\tC: %s\tV: %s" % (h, c, v))
 
-    print("Drawing the tree")
-    plot_dendrogram(tree, "Dendrogram with %s percent cutoff" % (cutoff_frac*100), treefname, topkwords, len(topkwords), cutoff_frac)
+    if sweepfracs:
+        print("Sweeping cutoffs")
+        for frac, h, c, v in sweep_cutoffs(tree, topkwords, typedict, sweepfracs):
+            print("cutoff %s\tH: %s\tC: %s\tV: %s" % (frac, h, c, v))
+
+    if treeoutname:
+        print("Writing the tree")
+        write_tree(tree, topkwords, treeoutname)
+
+    if render != "none":
+        print("Drawing the tree")
+        plot_dendrogram(tree, "Dendrogram with %s percent cutoff" % (cutoff_frac*100), treefname, topkwords, len(topkwords), cutoff_frac,
+                        show=render == "show", topn=topn)
     print("Done!")
 
 if __name__=="__main__":
-    main(True if sys.argv[1].lower() == "true" else False, int(sys.argv[2]), int(sys.argv[3]), float(sys.argv[4]), sys.argv[5], sys.argv[6])
+    parser = argparse.ArgumentParser()
+    parser.add_argument("use_universal")
+    parser.add_argument("k_tree", type=int)
+    parser.add_argument("k_context", type=int)
+    parser.add_argument("cutoff_frac", type=float)
+    parser.add_argument("distfuncname")
+    parser.add_argument("treefname")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes for the pool backend (default: all cores), or rows and columns of tiles for the threads backend (default: 8)")
+    parser.add_argument("--backend", choices=["auto", "batched", "pool", "threads"], default="auto",
+                        help="auto uses the batched engine for the built-in metrics and the process pool otherwise")
+    parser.add_argument("--ingest", choices=["lists", "stream"], default="lists",
+                        help="lists uses read_corpus and get_poscounts, stream reads Brown once with ingest_corpus, "
+                             "which counts the POS tags itself")
+    parser.add_argument("--categories", default="news", help="comma-separated Brown categories for --ingest stream, or 'all'")
+    parser.add_argument("--cache-dir", default=os.path.join(os.path.expanduser("~"), ".cache", "lin220_hw4"),
+                        help="where context vectors and distances are cached between runs")
+    parser.add_argument("--cache-size-mb", type=int, default=1024, help="least recently used entries are evicted past this size")
+    parser.add_argument("--no-cache", action="store_true", help="neither read nor write the cache")
+    parser.add_argument("--sweep", default=None, help="comma-separated cutoff fractions to also evaluate from the same tree")
+    parser.add_argument("--render", choices=["show", "save", "none"], default="show",
+                        help="show saves and displays the dendrogram, save only writes it headlessly, none skips matplotlib entirely")
+    parser.add_argument("--top-n", type=int, default=None, help="only draw the top n clusters of the dendrogram")
+    parser.add_argument("--tree-out", default=None, help="also write the linkage to this .json or Newick file")
+    parser.add_argument("--approx-knn", type=int, default=None,
+                        help="cluster from each word's K nearest neighbours instead of all pairwise distances, for very large k_tree")
+    args = parser.parse_args()
+    categories = None if args.categories == "all" else args.categories.split(",")
+    main(True if args.use_universal.lower() == "true" else False, args.k_tree, args.k_context, args.cutoff_frac, args.distfuncname, args.treefname,
+         numworkers=args.workers, backend=args.backend, ingest=args.ingest, categories=categories,
+         cachedir=None if args.no_cache else args.cache_dir, cachebytes=args.cache_size_mb*2**20,
+         sweepfracs=[float(frac) for frac in args.sweep.split(",")] if args.sweep else None,
+         render=args.render, topn=args.top_n, treeoutname=args.tree_out, numneighbours=args.approx_knn)
 
 
 